@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Creates/sec with the per-row counter against the hi/lo allocator
+
+Needs a running mongod. Usage:
+
+    python benchmarks/bench_id_allocator.py [--uri URI] [--rows N]
+                                            [--threads N] [--block N]
+"""
+import os
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from pymongo import MongoClient
+import id_allocator
+
+
+def run(db, rows, threads, next_ids):
+    """Insert rows documents from threads workers, each one taking its
+    id from next_ids(). Returns the elapsed time and the ids used."""
+    collection = db['bench_id_allocator']
+    collection.drop()
+    used = []
+
+    def worker(n):
+        ids = []
+        for i in xrange(n):
+            new_id = next_ids()
+            collection.insert_one({'id': new_id, 'name': 'row %s' % i})
+            ids.append(new_id)
+        used.extend(ids)
+
+    per_thread = rows / threads
+    workers = [threading.Thread(target=worker, args=(per_thread,))
+               for x in xrange(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.time() - start, used
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--uri', default='mongodb://localhost:27017/')
+    parser.add_option('--db', default='bench_mongodb_backend')
+    parser.add_option('--rows', type='int', default=20000)
+    parser.add_option('--threads', type='int', default=4)
+    parser.add_option('--block', type='int', default=1000)
+    options, args = parser.parse_args()
+
+    db = MongoClient(options.uri)[options.db]
+    counters = db['counters']
+    counters.delete_many({'_id': {'$in': ['bench_row', 'bench_block']}})
+    counters.insert_many([{'_id': 'bench_row', 'counter': 1},
+                          {'_id': 'bench_block', 'counter': 1}])
+
+    allocator = id_allocator.IdBlockAllocator(lambda: counters,
+                                              'bench_block', options.block)
+    modes = [
+        ('per_row_counter',
+         lambda: id_allocator.reserve_ids(counters, 'bench_row', 1)[0]),
+        ('block_allocator', lambda: allocator.allocate(1)[0]),
+    ]
+    for name, next_ids in modes:
+        elapsed, used = run(db, options.rows, options.threads, next_ids)
+        assert len(used) == len(set(used)), 'duplicated ids'
+        print '%-16s %8d rows %6.2fs %10.1f creates/sec' % (
+            name, len(used), elapsed, len(used) / elapsed)
+    db['bench_id_allocator'].drop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""explain() of LIKE searches on an indexed field, comparing the old
+unanchored translation with the current one
+
+Needs a running mongod. Usage:
+
+    python benchmarks/bench_like_explain.py [--uri URI] [--rows N]
+"""
+import re
+import time
+from optparse import OptionParser
+
+import stubs
+stubs.install()
+
+from pymongo import MongoClient, ASCENDING
+import mongodb2
+
+
+def old_like(field, value):
+    return {field: {'$regex': re.compile(value.replace('%', '.*'))}}
+
+
+def summary(collection, query):
+    start = time.time()
+    explain = collection.find(query).explain()
+    elapsed = time.time() - start
+    stats = explain.get('executionStats', {})
+    stage = explain.get('queryPlanner', {}).get('winningPlan', {})
+    stages = []
+    while stage:
+        stages.append(stage.get('stage'))
+        stage = stage.get('inputStage')
+    return {'plan': '>'.join(s for s in stages if s),
+            'keys': stats.get('totalKeysExamined'),
+            'docs': stats.get('totalDocsExamined'),
+            'returned': stats.get('nReturned'),
+            'ms': stats.get('executionTimeMillis', elapsed * 1000)}
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--uri', default='mongodb://localhost:27017/')
+    parser.add_option('--db', default='bench_mongodb_backend')
+    parser.add_option('--rows', type='int', default=200000)
+    options, args = parser.parse_args()
+
+    collection = MongoClient(options.uri)[options.db]['bench_like']
+    collection.drop()
+    batch = []
+    for i in xrange(options.rows):
+        batch.append({'id': i, 'code': 'C%07d' % i})
+        if len(batch) == 10000:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+    #select=True fields get a single field index in _auto_init
+    collection.create_index([('code', ASCENDING)])
+
+    for pattern in ('C00012%', 'C0001%', '%0012', 'C%12'):
+        old = summary(collection, old_like('code', pattern))
+        new = summary(collection,
+                      mongodb2.mdbpool.translate_domain(
+                          [('code', 'like', pattern)]))
+        for name, res in (('before', old), ('after', new)):
+            print '%-9s %-6s %-28s keys=%-8s docs=%-8s returned=%-6s ' \
+                  '%sms' % (pattern, name, res['plan'], res['keys'],
+                            res['docs'], res['returned'], res['ms'])
+    collection.drop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Records/sec of the read post processing: the fused read plan
+against the former four passes (dates, GridFS, function fields and the
+_id/id/None cleanup in read)
+
+Pure Python, no mongod needed. Usage:
+
+    python benchmarks/bench_read_pipeline.py [--rows N,N...]
+"""
+import time
+from datetime import datetime
+from optparse import OptionParser
+
+import stubs
+stubs.install()
+
+from osv import fields
+import orm_mongodb
+
+
+class bench_model(orm_mongodb.orm_mongodb):
+    _name = 'bench.model'
+    _table = 'bench_model'
+    _columns = dict([('name', fields.char('Name')),
+                     ('active', fields.boolean('Active')),
+                     ('amount', fields.float('Amount')),
+                     ('date', fields.date('Date')),
+                     ('stamp', fields.datetime('Stamp'))] +
+                    [('char_%s' % i, fields.char('Char %s' % i))
+                     for i in range(20)])
+
+
+def documents(rows):
+    now = datetime(2011, 5, 1, 10, 30)
+    docs = []
+    for i in xrange(rows):
+        doc = {'_id': i, 'id': float(i), 'name': 'Record %s' % i,
+               'active': True, 'amount': i * 1.5, 'date': now,
+               'stamp': now}
+        for j in range(20):
+            doc['char_%s' % j] = j % 3 and 'value %s' % j or None
+        docs.append(doc)
+    return docs
+
+
+def legacy(model, fields_to_read, res):
+    """Post processing as done before the read plans: dates, GridFS
+    and the cleanup of read, each one in its own pass"""
+    formats = {'date': '%Y-%m-%d', 'datetime': '%Y-%m-%d %H:%M:%S'}
+    date_fields = [key for key, val in model._columns.iteritems()
+                   if val._type in formats]
+    date_fields_to_read = list(set(fields_to_read) & set(date_fields))
+    for val in res:
+        for date_field in date_fields_to_read:
+            if val.get(date_field):
+                val[date_field] = val[date_field].strftime(
+                    formats[model._columns[date_field]._type])
+    binary_fields = [key for key, val in model._columns.iteritems()
+                     if val._type in ('binary')
+                     and getattr(val, 'gridfs', False)]
+    list(set(fields_to_read) & set(binary_fields))
+    for r in res:
+        for key, v in r.items():
+            if key == '_id':
+                del r[key]
+                continue
+            if key == 'id':
+                r[key] = int(v)
+                continue
+            if v is None:
+                r[key] = False
+
+
+def fused(model, fields_to_read, res):
+    plan = model.get_read_plan(fields_to_read)
+    model.apply_read_plan(None, 1, plan, [], res)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--rows', default='10000,100000')
+    parser.add_option('--repeat', type='int', default=3)
+    options, args = parser.parse_args()
+
+    model = object.__new__(bench_model)
+    model._count_cache = {}
+    model._read_plans = orm_mongodb.LRUCache(256)
+    fields_to_read = bench_model._columns.keys()
+    for rows in [int(x) for x in options.rows.split(',')]:
+        for name, process in (('four_passes', legacy), ('read_plan', fused)):
+            best = None
+            for i in range(options.repeat):
+                res = documents(rows)
+                start = time.time()
+                process(model, fields_to_read, res)
+                elapsed = time.time() - start
+                best = best is None and elapsed or min(best, elapsed)
+            print '%-12s %8d rows %8.3fs %12.1f records/sec' % (
+                name, rows, best, rows / best)
+
+
+if __name__ == '__main__':
+    main()
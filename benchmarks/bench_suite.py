@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""Throughput of the main orm_mongodb and fields.gridfs operations
+
+Runs every scenario against a local mongod, or against mongomock as an
+in-process stand-in (--backend memory), and prints a JSON report with
+ops/sec, p50/p99 latency per call and memory growth of each scenario, to
+compare versions of the backend:
+
+    python benchmarks/bench_suite.py [--backend mongod|memory] [--uri URI]
+                                     [--rows N] [--page N] [--blob BYTES]
+                                     [--scenarios a,b...] [--label TEXT]
+                                     [--output FILE]
+
+Figures of the memory backend only compare versions with each other,
+they say nothing about a real server.
+
+rss_growth_kb is how much the scenario raised the peak resident memory
+of the process, 0 when it stayed below the peak of the scenarios run
+before it. Run a scenario alone (--scenarios name) for its own peak.
+process_peak_rss_kb is the peak of the whole process so far.
+"""
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from optparse import OptionParser
+
+import stubs
+
+DB_NAME = 'bench_mongodb_backend'
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(latencies, fraction):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    return latencies[int(round(fraction * (len(latencies) - 1)))] * 1000
+
+
+class Timer(object):
+    """Latencies of the calls of a scenario"""
+
+    def __init__(self):
+        self.latencies = []
+        self.records = 0
+        self.start_rss = peak_rss_kb()
+
+    def __call__(self, func, *args, **kwargs):
+        start = time.time()
+        res = func(*args, **kwargs)
+        self.latencies.append(time.time() - start)
+        return res
+
+    def report(self):
+        elapsed = sum(self.latencies)
+        peak = peak_rss_kb()
+        return {
+            'calls': len(self.latencies),
+            'records': self.records,
+            'seconds': elapsed,
+            'ops_per_sec': elapsed and self.records / elapsed or None,
+            'p50_ms': percentile(self.latencies, 0.5),
+            'p99_ms': percentile(self.latencies, 0.99),
+            'rss_growth_kb': peak - self.start_rss,
+            'process_peak_rss_kb': peak,
+        }
+
+
+def setup(options):
+    """Install the stubs, connect the backend and return the models"""
+    stubs.install({'mongodb_name': DB_NAME, 'mongodb_uri': options.uri})
+    import mongodb2
+    if options.backend == 'memory':
+        import mongomock
+        import mongomock.gridfs
+        if 'builtins' not in sys.modules:
+            #mongomock GridFS support imports the python 3 name
+            import __builtin__
+            sys.modules['builtins'] = __builtin__
+        mongomock.gridfs.enable_gridfs_integration()
+        client = mongomock.MongoClient()
+        mongodb2.mdbpool.mongo_connect = lambda: client
+
+    from osv import fields
+    import orm_mongodb
+    import fields as mongodb_fields
+
+    class bench_record(orm_mongodb.orm_mongodb):
+        _name = 'bench.record'
+        _table = 'bench_record'
+        _order = 'id'
+        _columns = {
+            'name': fields.char('Name', size=64, select=True),
+            'active': fields.boolean('Active'),
+            'amount': fields.float('Amount'),
+            'quantity': fields.integer('Quantity'),
+            'date': fields.date('Date'),
+            'stamp': fields.datetime('Stamp'),
+            'attachment': fields.binary('Attachment', gridfs=True),
+        }
+
+    class bench_document(stubs._orm_template):
+        _name = 'bench.document'
+        _table = 'bench_document'
+        _columns = {'doc': mongodb_fields.gridfs('Document')}
+
+    return mongodb2.mdbpool, bench_record, bench_document
+
+
+def values(i, blob=None):
+    vals = {
+        'name': 'Record %s' % i,
+        'active': bool(i % 2),
+        'amount': i * 1.5,
+        'quantity': i % 100,
+        'date': '2011-%02d-%02d' % (i % 12 + 1, i % 28 + 1),
+        'stamp': '2011-05-01 10:%02d:00' % (i % 60),
+    }
+    if blob:
+        vals['attachment'] = blob
+    return vals
+
+
+def reset(pool, model_class):
+    db = pool.get_db()
+    db.drop_collection(model_class._table)
+    db['counters'].delete_many({'_id': model_class._table})
+    db['schema_fingerprints'].delete_many({'_id': model_class._table})
+    db.fs.files.delete_many({})
+    db.fs.chunks.delete_many({})
+    model = stubs.make_model(model_class)
+    model._auto_init(stubs.Cursor())
+    return model
+
+
+def populate(model, options, blob=None):
+    return model.create_many(None, 1, [values(i, blob)
+                                       for i in xrange(options.rows)])
+
+
+def scenario_create(model, options, timer):
+    for i in xrange(options.rows):
+        timer(model.create, None, 1, values(i))
+        timer.records += 1
+
+
+def scenario_create_many(model, options, timer):
+    for start in xrange(0, options.rows, options.page):
+        count = min(options.page, options.rows - start)
+        timer(model.create_many, None, 1,
+              [values(start + i) for i in xrange(count)])
+        timer.records += count
+
+
+def scenario_read(model, options, timer):
+    ids = populate(model, options)
+    fields = ['name', 'active', 'amount', 'quantity', 'date', 'stamp']
+    for start in xrange(0, len(ids), options.page):
+        res = timer(model.read, None, 1, ids[start:start + options.page],
+                    fields)
+        timer.records += len(res)
+
+
+def scenario_search(model, options, timer):
+    populate(model, options)
+    domains = [
+        ([('name', 'like', 'Record 1%')], None),
+        ([('name', 'ilike', 'record 2')], None),
+        ([('amount', '>', options.rows / 2), ('active', '=', True)],
+         'amount desc'),
+        ([('date', '>=', '2011-06-01'), ('quantity', '<', 50)],
+         'date desc, id'),
+        (['|', ('quantity', '=', 1), ('quantity', '=', 2)], None),
+    ]
+    for i in xrange(max(options.rows / 10, len(domains))):
+        domain, order = domains[i % len(domains)]
+        res = timer(model.search, None, 1, domain, 0, options.page, order)
+        timer.records += len(res)
+
+
+def scenario_paginate_offset(model, options, timer):
+    populate(model, options)
+    offset = 0
+    while True:
+        res = timer(model.search, None, 1, [('quantity', '>=', 0)], offset,
+                    options.page, 'id')
+        if not res:
+            break
+        timer.records += len(res)
+        offset += options.page
+
+
+def scenario_paginate_keyset(model, options, timer):
+    populate(model, options)
+    after = None
+    while True:
+        res = timer(model.search, None, 1, [('quantity', '>=', 0)], 0,
+                    options.page, 'id', None, False, after)
+        if not res:
+            break
+        timer.records += len(res)
+        after = res[-1]
+
+
+def scenario_write(model, options, timer):
+    ids = populate(model, options)
+    for i, record_id in enumerate(ids):
+        timer(model.write, None, 1, [record_id], {'amount': i * 2.5,
+                                                  'date': '2012-01-01'})
+        timer.records += 1
+
+
+def scenario_write_many(model, options, timer):
+    ids = populate(model, options)
+    for start in xrange(0, len(ids), options.page):
+        chunk = ids[start:start + options.page]
+        timer(model.write_many, None, 1,
+              dict((record_id, {'amount': record_id * 2.5})
+                   for record_id in chunk))
+        timer.records += len(chunk)
+
+
+def scenario_unlink_gridfs(model, options, timer):
+    ids = populate(model, options, 'x' * options.blob)
+    for start in xrange(0, len(ids), options.page):
+        chunk = ids[start:start + options.page]
+        timer(model.unlink, None, 1, chunk)
+        timer.records += len(chunk)
+
+
+def _gridfs_document(document_class, options):
+    cr = stubs.Cursor()
+    obj = stubs.make_model(document_class, cr)
+    field = document_class._columns['doc']
+    ids = range(1, options.rows + 1)
+    return cr, obj, field, ids
+
+
+def scenario_gridfs_set(document_class, options, timer):
+    cr, obj, field, ids = _gridfs_document(document_class, options)
+    for rid in ids:
+        timer(field.set, cr, obj, rid, 'doc', 'x' * options.blob)
+        timer.records += 1
+
+
+def _gridfs_get(document_class, options, timer, context):
+    cr, obj, field, ids = _gridfs_document(document_class, options)
+    for rid in ids:
+        field.set(cr, obj, rid, 'doc', 'x' * options.blob)
+    for start in xrange(0, len(ids), options.page):
+        chunk = ids[start:start + options.page]
+        timer(field.get, cr, obj, chunk, 'doc', context=context)
+        timer.records += len(chunk)
+
+
+def scenario_gridfs_get(document_class, options, timer):
+    _gridfs_get(document_class, options, timer, {})
+
+
+def scenario_gridfs_get_bin_size(document_class, options, timer):
+    _gridfs_get(document_class, options, timer, {'bin_size': True})
+
+
+SCENARIOS = [
+    ('create', scenario_create),
+    ('create_many', scenario_create_many),
+    ('read', scenario_read),
+    ('search', scenario_search),
+    ('paginate_offset', scenario_paginate_offset),
+    ('paginate_keyset', scenario_paginate_keyset),
+    ('write', scenario_write),
+    ('write_many', scenario_write_many),
+    ('unlink_gridfs', scenario_unlink_gridfs),
+    ('gridfs_set', scenario_gridfs_set),
+    ('gridfs_get', scenario_gridfs_get),
+    ('gridfs_get_bin_size', scenario_gridfs_get_bin_size),
+]
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--backend', default='mongod',
+                      help='mongod or memory (mongomock)')
+    parser.add_option('--uri', default='mongodb://localhost:27017/')
+    parser.add_option('--rows', type='int', default=2000)
+    parser.add_option('--page', type='int', default=80)
+    parser.add_option('--blob', type='int', default=16 * 1024)
+    parser.add_option('--scenarios', default=','.join(
+                                            name for name, f in SCENARIOS))
+    parser.add_option('--label', default='')
+    parser.add_option('--output', default='-')
+    options, args = parser.parse_args()
+
+    pool, record_class, document_class = setup(options)
+    import pymongo
+    report = {
+        'label': options.label,
+        'backend': options.backend,
+        'rows': options.rows,
+        'page': options.page,
+        'blob': options.blob,
+        'python': platform.python_version(),
+        'pymongo': pymongo.version,
+        'scenarios': {},
+    }
+    selected = options.scenarios.split(',')
+    for name, scenario in SCENARIOS:
+        if name not in selected:
+            continue
+        model = reset(pool, record_class)
+        timer = Timer()
+        if name.startswith('gridfs_'):
+            scenario(document_class, options, timer)
+        else:
+            scenario(model, options, timer)
+        report['scenarios'][name] = timer.report()
+        sys.stderr.write('%-20s %10.1f ops/sec\n' % (
+            name, report['scenarios'][name]['ops_per_sec'] or 0))
+    reset(pool, record_class)
+    pool.get_db().drop_collection(record_class._table)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output == '-':
+        print output
+    else:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Writes/sec of the orm write path under each _write_concern mode,
+against the former update plus getLastError round trip
+
+Needs a running mongod (a replica set for the majority mode). Usage:
+
+    python benchmarks/bench_write_concern.py [--uri URI] [--rows N]
+                                             [--modes legacy,w0,w1,majority]
+"""
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from pymongo import MongoClient
+from pymongo.write_concern import WriteConcern
+
+MODES = {
+    'w0': {'w': 0},
+    'w1': {'w': 1},
+    'majority': {'w': 'majority', 'j': True},
+}
+
+
+def run(db, rows, mode):
+    """Update rows documents one by one, the way write() does"""
+    name = 'bench_write_concern'
+    if mode == 'legacy':
+        collection = db[name]
+    else:
+        collection = db.get_collection(name,
+                                       write_concern=WriteConcern(**MODES[mode]))
+    start = time.time()
+    for i in xrange(1, rows + 1):
+        collection.update_many({'id': {'$in': [i]}},
+                               {'$set': {'name': 'row %s %s' % (i, mode)}})
+        if mode == 'legacy':
+            #The getLastError round trip the orm used to make after
+            #every write
+            db.command('getlasterror')
+    #Wait for the unacknowledged writes before stopping the clock
+    db.command('ping')
+    return time.time() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--uri', default='mongodb://localhost:27017/')
+    parser.add_option('--db', default='bench_mongodb_backend')
+    parser.add_option('--rows', type='int', default=20000)
+    parser.add_option('--modes', default='legacy,w0,w1,majority')
+    options, args = parser.parse_args()
+
+    db = MongoClient(options.uri)[options.db]
+    collection = db['bench_write_concern']
+    collection.drop()
+    collection.create_index('id', unique=True)
+    collection.insert_many([{'id': i, 'name': 'row %s' % i}
+                            for i in xrange(1, options.rows + 1)])
+    for mode in options.modes.split(','):
+        elapsed = run(db, options.rows, mode)
+        print '%-10s %8d writes %6.2fs %10.1f writes/sec' % (
+            mode, options.rows, elapsed, options.rows / elapsed)
+    collection.drop()
+
+
+if __name__ == '__main__':
+    main()
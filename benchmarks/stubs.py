@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Minimal stand-ins for the OpenERP server modules (tools, netsvc and
+osv) so the backend modules can be imported by the benchmarks outside
+of a running server. The real modules are used when importable."""
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def _human_size(sz):
+    if isinstance(sz, basestring):
+        sz = len(sz)
+    units = ('bytes', 'Kb', 'Mb', 'Gb')
+    i = 0
+    while sz >= 1024 and i < len(units) - 1:
+        sz = sz / 1024.0
+        i += 1
+    return '%0.2f %s' % (sz, units[i])
+
+
+class _Logger(object):
+
+    def notifyChannel(self, name, level, msg):
+        if level in ('warning', 'error'):
+            sys.stderr.write('%s:%s:%s\n' % (level, name, msg))
+
+
+class except_orm(Exception):
+
+    def __init__(self, name, value):
+        Exception.__init__(self, name, value)
+        self.name = name
+        self.value = value
+
+
+class _column(object):
+    _type = 'unknown'
+    _classic_read = True
+    _classic_write = True
+    _multi = False
+    _symbol_set = ('%s', lambda x: x)
+
+    def __init__(self, string='unknown', **args):
+        self.string = string
+        self.__dict__.update(args)
+
+    def set(self, cr, obj, id, name, value, user=None, context=None):
+        cr.execute('update ' + obj._table + ' set ' + name + '=' +
+                   self._symbol_set[0] + ' where id=%s',
+                   (self._symbol_set[1](value), id))
+
+
+def _field(name, ttype, **attrs):
+    attrs['_type'] = ttype
+    return type(name, (_column,), attrs)
+
+
+class _orm_template(object):
+    CONCURRENCY_CHECK_FIELD = '__last_update'
+    _name = None
+    _table = None
+    _order = 'id'
+    _columns = {}
+    _defaults = {}
+
+    def __init__(self, cr):
+        pass
+
+    def _field_create(self, cr, context=None):
+        pass
+
+
+class Access(object):
+    """ir.model.access granting everything"""
+
+    def check(self, cr, uid, model, mode='read', context=None):
+        return True
+
+
+class Pool(dict):
+    """Model pool answering ir.model.access with Access"""
+
+    def get(self, name):
+        return dict.get(self, name) or Access()
+
+
+class Cursor(object):
+    """Database cursor of the PostgreSQL columns of fields.gridfs:
+    keeps the values written by _column.set and answers the
+    'select id, <name> from <table> where id in %s' of get_oids"""
+
+    def __init__(self):
+        self.values = {}
+        self._result = []
+
+    def execute(self, query, params=None):
+        words = query.split()
+        if words[0] == 'update':
+            value, rid = params
+            self.values[(words[1], words[3].split('=')[0], rid)] = value
+        elif words[0] == 'select':
+            table, name = words[4], words[2]
+            self._result = [(rid, self.values.get((table, name, rid)))
+                            for rid in params[0]]
+        else:
+            self._result = []
+
+    def fetchall(self):
+        return self._result
+
+
+def make_model(cls, cr=None):
+    """Instance of the orm_mongodb model class cls outside of a pool"""
+    model = cls.__new__(cls)
+    model.pool = Pool()
+    cls.__init__(model, cr or Cursor())
+    return model
+
+
+def install(config=None):
+    """Register the stand-in modules that are not importable"""
+    try:
+        import tools
+    except ImportError:
+        _module('tools', config=dict(config or {}), human_size=_human_size)
+        _module('tools.translate', _=lambda text: text)
+    try:
+        import netsvc
+    except ImportError:
+        _module('netsvc', Logger=_Logger, LOG_DEBUG='debug',
+                LOG_INFO='info', LOG_WARNING='warning', LOG_ERROR='error')
+    try:
+        import osv
+    except ImportError:
+        _module('osv')
+        _module('osv.orm', except_orm=except_orm,
+                orm_template=_orm_template)
+        _module('osv.fields',
+                _column=_column,
+                char=_field('char', 'char'),
+                text=_field('text', 'text'),
+                boolean=_field('boolean', 'boolean'),
+                integer=_field('integer', 'integer', _symbol_set=(
+                    '%s', lambda x: int(x or 0))),
+                float=_field('float', 'float', _symbol_set=(
+                    '%s', lambda x: float(x or 0.0))),
+                date=_field('date', 'date'),
+                datetime=_field('datetime', 'datetime'),
+                binary=_field('binary', 'binary'),
+                function=_field('function', 'function',
+                                _classic_read=False, _classic_write=False))
+        sys.modules['osv'].orm = sys.modules['osv.orm']
+        sys.modules['osv'].fields = sys.modules['osv.fields']
@@ -6,6 +6,7 @@ from tools import human_size
 import pymongo
 import gridfs as gfs
 from mongodb2 import mdbpool
+import gridfs_store
 from bson.objectid import ObjectId
 
 
@@ -20,6 +21,9 @@ class gridfs(char):
 
     def __init__(self, string, **args):
         self.versioning = False
+        #Store identical contents once (see gridfs_store.put).
+        #Ignored with versioning, which relies on per record filenames
+        self.dedup = False
         super(gridfs, self).__init__(string=string, size=24, widget='binary',
                                      **args)
 
@@ -35,16 +39,16 @@ class gridfs(char):
     def set(self, cursor, obj, rid, name, value, user=None, context=None):
         # TODO: Store some more metadata. File name, author, etc.
         db = mdbpool.get_db()
-        fs = gfs.GridFS(db, collection='fs')
+        dedup = self.dedup and not self.versioning
         for rid, oid in self.get_oids(cursor, obj, [rid], name).items():
             filename = self.get_filename(obj, rid, name)
-            if oid and fs.exists(ObjectId(oid)) and not self.versioning:
-                fs.delete(ObjectId(oid))
+            if oid and not self.versioning:
+                gridfs_store.release(db, ObjectId(oid))
             if value:
-                _id = fs.put(value, filename=filename)
+                _id = gridfs_store.put(db, value, dedup, filename=filename)
                 value = str(_id)
             if not value and self.versioning:
-                fs.delete(ObjectId(oid))
+                gridfs_store.release(db, ObjectId(oid))
                 res = db.fs.files.find(
                     {'filename': filename},
                     {'uploadDate': True, '_id': True}
@@ -59,21 +63,32 @@ class gridfs(char):
         if not context:
             context = {}
         db = mdbpool.get_db()
-        fs = gfs.GridFS(db, collection='fs')
         res = self.get_oids(cursor, obj, ids, name)
+        if context.get('bin_size', False):
+            return self.get_sizes(db, obj, res, name)
+        fs = gfs.GridFS(db, collection='fs')
         for rid, oid in res.items():
-            filename = self.get_filename(obj, rid, name)
             if oid:
-                oid = ObjectId(oid)
-                val = fs.get(oid).read()
-                if context.get('bin_size', False) and val:
-                    version = db.fs.files.find(
-                        {'filename': filename},
-                        {'uploadDate': True, '_id': False}
-                    ).count()
-                    res[rid] = '%s - v%s' % (human_size(val), version)
-                else:
-                    res[rid] = val
+                res[rid] = fs.get(ObjectId(oid)).read()
+            else:
+                res[rid] = False
+        return res
+
+    def get_sizes(self, db, obj, oids, name):
+        """bin_size values of {id: oid} from the fs.files metadata, with
+        one query for the sizes and one for the version counts"""
+        sizes = gridfs_store.file_sizes(db, gridfs_store.to_objectids(
+            oids.values()))
+        filenames = [self.get_filename(obj, rid, name)
+                     for rid, oid in oids.items() if oid]
+        versions = gridfs_store.version_counts(db, filenames)
+        res = {}
+        for rid, oid in oids.items():
+            size = oid and sizes.get(ObjectId(oid))
+            if size:
+                #Deduplicated files keep the name of their first record
+                version = versions.get(self.get_filename(obj, rid, name), 1)
+                res[rid] = '%s - v%s' % (human_size(size), version)
             else:
                 res[rid] = False
         return res
@@ -0,0 +1,295 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP - MongoDB backend
+#    Copyright (C) 2011 Joan M. Grande
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""Batched access to the GridFS 'fs' bucket shared by the gridfs field
+and the binary gridfs columns of orm_mongodb"""
+
+import hashlib
+from collections import Counter
+from Queue import Queue
+from threading import Lock, Thread
+import netsvc
+from bson.objectid import ObjectId
+from gridfs import GridFS
+from gridfs.grid_file import GridOut
+
+#fs.files keys of the content addressed files: the sha256 of the
+#content and the number of values referencing the file
+HASH_KEY = 'sha256'
+REFCOUNT_KEY = 'refcount'
+
+_indexed = set()
+
+
+def to_objectids(values):
+    """ObjectIds of the non empty values, without duplicates"""
+    res = []
+    seen = set()
+    for value in values:
+        if not value:
+            continue
+        oid = ObjectId(value)
+        if oid not in seen:
+            seen.add(oid)
+            res.append(oid)
+    return res
+
+
+def put(db, value, dedup=False, refs=1, **kwargs):
+    """Store value in GridFS for refs references and return its
+    ObjectId.
+
+    With dedup the file is content addressed: when a file with the same
+    sha256 exists its reference count is increased and its ObjectId
+    returned, so identical contents are stored once.
+    """
+    fs = GridFS(db, collection='fs')
+    if not dedup:
+        if refs != 1:
+            kwargs[REFCOUNT_KEY] = refs
+        return fs.put(value, **kwargs)
+    if db.name not in _indexed:
+        db.fs.files.create_index(HASH_KEY, sparse=True)
+        _indexed.add(db.name)
+    digest = hashlib.sha256(value).hexdigest()
+    doc = db.fs.files.find_one_and_update({HASH_KEY: digest},
+                                          {'$inc': {REFCOUNT_KEY: refs}},
+                                          projection={'_id': True})
+    if doc:
+        return doc['_id']
+    kwargs.update({HASH_KEY: digest, REFCOUNT_KEY: refs})
+    return fs.put(value, **kwargs)
+
+
+def release(db, oid):
+    """Drop one reference to the file oid. The file and its chunks are
+    deleted with the last reference; files stored without dedup have a
+    single one."""
+    files = db.fs.files
+    while True:
+        if files.find_one_and_update({'_id': oid,
+                                      REFCOUNT_KEY: {'$gt': 1}},
+                                     {'$inc': {REFCOUNT_KEY: -1}},
+                                     projection={'_id': True}):
+            return
+        #Conditional delete, a concurrent put may have taken a new
+        #reference since the decrement failed
+        res = files.delete_one({'_id': oid,
+                                '$or': [{REFCOUNT_KEY: {'$lte': 1}},
+                                        {REFCOUNT_KEY: {'$exists': False}}]})
+        if res.deleted_count or not files.find_one({'_id': oid},
+                                                   {'_id': True}):
+            db.fs.chunks.delete_many({'files_id': oid})
+            return
+
+
+def legacy_files(db, oids):
+    """The files of oids stored before reference counting, without
+    refcount. A single one may be shared by several records"""
+    if not oids:
+        return set()
+    cursor = db.fs.files.find({'_id': {'$in': list(set(oids))},
+                               REFCOUNT_KEY: {'$exists': False}},
+                              {'_id': True})
+    return set(doc['_id'] for doc in cursor)
+
+
+def release_many(db, oids, chunk_size=1000):
+    """Drop one reference for every item of oids, which may repeat,
+    with a few $in queries per chunk_size files instead of several
+    round trips per file"""
+    files = db.fs.files
+    counts = Counter(oids)
+    oids = counts.keys()
+    for start in xrange(0, len(oids), chunk_size):
+        chunk = oids[start:start + chunk_size]
+        by_refs = {}
+        for oid in chunk:
+            by_refs.setdefault(counts[oid], []).append(oid)
+        #Files losing their last reference
+        for refs, group in by_refs.iteritems():
+            files.delete_many({'_id': {'$in': group},
+                               '$or': [{REFCOUNT_KEY: {'$lte': refs}},
+                                       {REFCOUNT_KEY: {'$exists': False}}]})
+        existing = set(doc['_id'] for doc in
+                       files.find({'_id': {'$in': chunk}}, {'_id': True}))
+        gone = [oid for oid in chunk if oid not in existing]
+        if gone:
+            db.fs.chunks.delete_many({'files_id': {'$in': gone}})
+        #Shared files, a concurrent put may have kept some of the
+        #deleted candidates alive as well
+        for refs, group in by_refs.iteritems():
+            group = [oid for oid in group if oid in existing]
+            if group:
+                files.update_many({'_id': {'$in': group},
+                                   REFCOUNT_KEY: {'$gt': refs}},
+                                  {'$inc': {REFCOUNT_KEY: -refs}})
+
+
+_cleanup_queue = Queue()
+_cleanup_lock = Lock()
+_cleanup_worker = []
+
+
+def _cleanup_loop():
+    logger = netsvc.Logger()
+    while True:
+        db, oids, chunk_size = _cleanup_queue.get()
+        try:
+            release_many(db, oids, chunk_size)
+        except Exception, e:
+            logger.notifyChannel('MongoDB', netsvc.LOG_ERROR,
+                                 'GridFS cleanup of %s files failed: %s'
+                                 % (len(oids), e))
+        finally:
+            _cleanup_queue.task_done()
+
+
+def release_many_async(db, oids, chunk_size=1000):
+    """Queue release_many to run on the background cleanup worker"""
+    if not _cleanup_worker:
+        with _cleanup_lock:
+            if not _cleanup_worker:
+                worker = Thread(target=_cleanup_loop,
+                                name='mongodb-gridfs-cleanup')
+                worker.daemon = True
+                worker.start()
+                _cleanup_worker.append(worker)
+    _cleanup_queue.put((db, list(oids), chunk_size))
+
+
+def file_documents(db, oids, projection=None):
+    """Return {ObjectId: fs.files document} for the existing files of
+    oids, fetched with a single $in query"""
+    if not oids:
+        return {}
+    cursor = db.fs.files.find({'_id': {'$in': list(oids)}}, projection)
+    return dict((doc['_id'], doc) for doc in cursor)
+
+
+def file_sizes(db, oids):
+    """Return {ObjectId: length} without downloading any content"""
+    docs = file_documents(db, oids, {'length': True})
+    return dict((oid, doc.get('length', 0)) for oid, doc in docs.iteritems())
+
+
+def version_counts(db, filenames):
+    """Return {filename: number of stored versions} with a single
+    aggregation"""
+    if not filenames:
+        return {}
+    cursor = db.fs.files.aggregate([
+        {'$match': {'filename': {'$in': list(filenames)}}},
+        {'$group': {'_id': '$filename', 'count': {'$sum': 1}}},
+    ])
+    return dict((doc['_id'], doc['count']) for doc in cursor)
+
+
+class LazyFile(object):
+    """Read only file-like proxy of a GridFS file.
+
+    Nothing is downloaded until the proxy is read: read(size) and
+    iteration stream the chunks on demand, str() loads the whole
+    content once and keeps it.
+    """
+
+    def __init__(self, root_collection, file_document):
+        self._root_collection = root_collection
+        self._file_document = file_document
+        self._grid_out = None
+        self._content = None
+
+    @property
+    def _file(self):
+        if self._grid_out is None:
+            self._grid_out = GridOut(self._root_collection,
+                                     file_document=self._file_document)
+        return self._grid_out
+
+    @property
+    def _id(self):
+        return self._file_document['_id']
+
+    @property
+    def length(self):
+        return self._file_document.get('length', 0)
+
+    @property
+    def filename(self):
+        return self._file_document.get('filename')
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readchunk(self):
+        return self._file.readchunk()
+
+    def seek(self, pos, whence=0):
+        return self._file.seek(pos, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        if self._grid_out is not None:
+            self._grid_out.close()
+            self._grid_out = None
+
+    def __iter__(self):
+        return iter(GridOut(self._root_collection,
+                            file_document=self._file_document))
+
+    def __len__(self):
+        return self.length
+
+    def __nonzero__(self):
+        return bool(self.length)
+
+    def __str__(self):
+        if self._content is None:
+            self._content = GridOut(self._root_collection,
+                                    file_document=self._file_document).read()
+        return self._content
+
+    def __eq__(self, other):
+        if isinstance(other, LazyFile):
+            return self._id == other._id
+        return str(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<LazyFile %s (%s bytes)>' % (self._id, self.length)
+
+
+def read_files(db, oids, lazy=False):
+    """Return {ObjectId: content} for the existing files of oids,
+    resolved with a single fs.files query. With lazy the contents are
+    LazyFile proxies instead of strings."""
+    docs = file_documents(db, oids)
+    res = {}
+    for oid, doc in docs.iteritems():
+        if lazy:
+            res[oid] = LazyFile(db.fs, doc)
+        else:
+            res[oid] = GridOut(db.fs, file_document=doc).read()
+    return res
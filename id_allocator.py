@@ -0,0 +1,103 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP - MongoDB backend
+#    Copyright (C) 2011 Joan M. Grande
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import os
+from threading import Lock
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+def reserve_ids(counters, name, count):
+    """Reserve count consecutive ids from the counters document
+    name with a single atomic increment. A missing document is created
+    first so ids start at 1, 0 means no record"""
+    while True:
+        counter = counters.find_one_and_update(
+                    {'_id': name},
+                    {'$inc': {'counter': count}},
+                    return_document=ReturnDocument.AFTER)
+        if counter:
+            break
+        try:
+            counters.update_one({'_id': name},
+                                {'$setOnInsert': {'counter': 1}},
+                                upsert=True)
+        except DuplicateKeyError:
+            #Created by a concurrent upsert
+            pass
+    first = counter['counter'] - count
+    return range(first, first + count)
+
+
+class IdBlockAllocator(object):
+    """Hi/lo id allocator
+
+    Leases blocks of block_size ids from the counters collection with
+    one atomic increment and hands them out locally until the block is
+    exhausted. Ids are unique across processes and monotonic within a
+    process. Ids left in a block when the process ends are lost.
+    """
+
+    def __init__(self, get_counters, name, block_size):
+        self._get_counters = get_counters
+        self._name = name
+        self._block_size = block_size
+        self._next = 0
+        self._last = -1
+        self._lock = Lock()
+
+    def allocate(self, count=1):
+        """Return a list of count new ids"""
+        with self._lock:
+            res = []
+            while len(res) < count:
+                if self._next > self._last:
+                    #Lease enough ids for the rest of the request
+                    #rounded up to whole blocks
+                    needed = count - len(res)
+                    blocks = (needed + self._block_size - 1) / self._block_size
+                    block = reserve_ids(self._get_counters(), self._name,
+                                        blocks * self._block_size)
+                    self._next, self._last = block[0], block[-1]
+                take = min(count - len(res), self._last - self._next + 1)
+                res.extend(xrange(self._next, self._next + take))
+                self._next += take
+            return res
+
+
+_allocators = {}
+_allocators_lock = Lock()
+
+
+def get_allocator(get_counters, name, block_size):
+    """Return the process wide allocator for the counters document
+    name, creating it on first use. Allocators are kept per process id
+    so a forked child never hands out the ids of a block leased by its
+    parent"""
+    key = (os.getpid(), name)
+    allocator = _allocators.get(key)
+    if allocator is None or allocator._block_size != block_size:
+        with _allocators_lock:
+            allocator = _allocators.get(key)
+            if allocator is None or allocator._block_size != block_size:
+                allocator = IdBlockAllocator(get_counters, name, block_size)
+                _allocators[key] = allocator
+    return allocator
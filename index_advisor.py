@@ -0,0 +1,231 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP - MongoDB backend
+#    Copyright (C) 2011 Joan M. Grande
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""Query shape statistics and compound index recommendations.
+
+A shape is what an index depends on in a query: the fields compared by
+equality, the sort keys and the fields compared by range. Following the
+ESR rule the index serving a shape has the equality fields first, then
+the sort keys and the range fields last.
+"""
+
+from threading import Lock
+import tools
+import netsvc
+import pymongo
+from bson.son import SON
+from pymongo.errors import OperationFailure
+from mongodb2 import config_flag
+
+#Operators the index can serve as an equality
+EQUALITY_OPERATORS = ('$eq', '$in')
+
+
+def _collect(spec, equality, ranges):
+    for key, value in spec.iteritems():
+        if key == '$and':
+            for part in value:
+                _collect(part, equality, ranges)
+        elif key.startswith('$'):
+            #$or, $nor, $where... can not be served by one index
+            continue
+        elif isinstance(value, dict) and value and \
+                all(op.startswith('$') for op in value):
+            if all(op in EQUALITY_OPERATORS for op in value):
+                equality.add(key)
+            else:
+                ranges.add(key)
+        elif hasattr(value, 'pattern'):
+            #Compiled regular expression
+            ranges.add(key)
+        else:
+            equality.add(key)
+
+
+def query_shape(spec, sort):
+    """Normalised shape of a query: (equality fields, sort keys,
+    range fields)"""
+    equality = set()
+    ranges = set()
+    _collect(spec or {}, equality, ranges)
+    return (tuple(sorted(equality)),
+            tuple((key, direction) for key, direction in sort or []),
+            tuple(sorted(ranges - equality)))
+
+
+def recommend_index(shape):
+    """Index keys serving shape, following the ESR rule"""
+    equality, sort, ranges = shape
+    keys = []
+    seen = set()
+    for key, direction in ([(field, pymongo.ASCENDING) for field in equality]
+                           + list(sort)
+                           + [(field, pymongo.ASCENDING) for field in ranges]):
+        if key not in seen:
+            seen.add(key)
+            keys.append((key, direction))
+        if key == 'id':
+            #Unique, the keys after it would never be used
+            break
+    return keys
+
+
+def is_covered(keys, indexes):
+    """Whether one of indexes, as returned by index_information,
+    starts with keys"""
+    for index in indexes.values():
+        index_keys = [(key, direction) for key, direction in index['key']]
+        if index_keys[:len(keys)] == keys:
+            return True
+    return False
+
+
+def plan_stages(plan):
+    """Names of the stages of an explain winning plan"""
+    stages = set()
+    while plan:
+        stages.add(plan.get('stage'))
+        for child in plan.get('inputStages', []):
+            stages.update(plan_stages(child))
+        plan = plan.get('inputStage')
+    return stages
+
+
+def winning_plan(collection, spec, sort):
+    """Plan the query planner chooses for the query, without running
+    it. None when the server can not explain it"""
+    command = SON([('find', collection.name), ('filter', spec or {})])
+    if sort:
+        command['sort'] = SON(sort)
+    try:
+        res = collection.database.command('explain', command,
+                                          verbosity='queryPlanner')
+    except OperationFailure:
+        return None
+    return res.get('queryPlanner', {}).get('winningPlan', {})
+
+
+class IndexAdvisor(object):
+    """Process wide statistics of the query shapes of search.
+
+    The first query of a shape and every explain_every queries after it
+    are explained to find collection scans and in memory sorts. At most
+    max_shapes shapes are tracked.
+    """
+
+    def __init__(self, explain_every=1000, max_shapes=1000):
+        self.explain_every = explain_every
+        self.max_shapes = max_shapes
+        self._shapes = {}
+        self._lock = Lock()
+
+    def record(self, collection, spec, sort, elapsed):
+        """Account a query that took elapsed seconds and return the
+        statistics of its shape, None when not tracked"""
+        shape = query_shape(spec, sort)
+        key = (collection.name, shape)
+        with self._lock:
+            stats = self._shapes.get(key)
+            if stats is None:
+                if len(self._shapes) >= self.max_shapes:
+                    return None
+                stats = self._shapes[key] = {
+                    'table': collection.name,
+                    'shape': shape,
+                    'index': recommend_index(shape),
+                    'count': 0,
+                    'total_time': 0.0,
+                    'max_time': 0.0,
+                    'explained': 0,
+                    'collscan': None,
+                    'in_memory_sort': None,
+                }
+            stats['count'] += 1
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            due = (stats['count'] - 1) % self.explain_every == 0
+        if due:
+            self.explain(collection, spec, sort, stats)
+        return stats
+
+    def explain(self, collection, spec, sort, stats):
+        """Update the plan flags of stats with the query planner
+        choice for the query, without running it"""
+        plan = winning_plan(collection, spec, sort)
+        if plan is None:
+            return
+        stages = plan_stages(plan)
+        stats['collscan'] = 'COLLSCAN' in stages
+        stats['in_memory_sort'] = 'SORT' in stages
+        stats['explained'] += 1
+
+    def report(self, table=None):
+        """Statistics of the shapes of table, or of all of them, the
+        slowest in total first"""
+        with self._lock:
+            res = [dict(stats) for stats in self._shapes.values()
+                   if table is None or stats['table'] == table]
+        for stats in res:
+            stats['avg_time'] = stats['total_time'] / stats['count']
+        res.sort(key=lambda stats: stats['total_time'], reverse=True)
+        return res
+
+    def clear(self):
+        with self._lock:
+            self._shapes.clear()
+
+
+advisor = IndexAdvisor(
+    explain_every=int(tools.config.get('mongodb_index_advisor_explain_every',
+                                       1000)),
+    max_shapes=int(tools.config.get('mongodb_index_advisor_shapes', 1000)))
+
+#Record the shapes of the searches of every model. Models with
+#_auto_indexes record theirs anyway
+recording = config_flag('mongodb_index_advisor')
+
+#Queries of a shape seen before its index is created by _auto_indexes
+min_count = int(tools.config.get('mongodb_index_advisor_min_count', 100))
+
+
+def needs_index(stats, indexes):
+    """Whether the explained shape of stats scans the collection or
+    sorts in memory for lack of an index"""
+    if not (stats['collscan'] or stats['in_memory_sort']):
+        return False
+    keys = stats['index']
+    return bool(keys) and not is_covered(keys, indexes)
+
+
+def log_report(table=None):
+    """Log the index recommendations of the recorded shapes"""
+    logger = netsvc.Logger()
+    for stats in advisor.report(table):
+        if not (stats['collscan'] or stats['in_memory_sort']):
+            continue
+        logger.notifyChannel('MongoDB', netsvc.LOG_INFO,
+            'index advisor: %s %s queries (avg %.1f ms, max %.1f ms)%s%s '
+            'would use index %s' % (
+                stats['table'], stats['count'], stats['avg_time'] * 1000,
+                stats['max_time'] * 1000,
+                stats['collscan'] and ' scan the collection' or '',
+                stats['in_memory_sort'] and ' sort in memory' or '',
+                stats['index']))
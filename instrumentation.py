@@ -0,0 +1,325 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP - MongoDB backend
+#    Copyright (C) 2011 Joan M. Grande
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""Timing of the ORM operations of the MongoDB models.
+
+Operations are timed per model and name into latency histograms. The
+MongoDB commands run while an operation is active are accounted to it
+(and to the operations enclosing it) by CommandListener: round trips,
+documents, server time and, with mongodb_instrumentation_bytes, reply
+bytes. Every finished operation is passed to the listeners, the slow
+operation log being the default one.
+
+Disabled unless mongodb_instrumentation is set, operations cost a flag
+check then.
+"""
+
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock, local
+from time import time
+import tools
+import netsvc
+from bson import BSON
+from pymongo import monitoring
+import index_advisor
+from mongodb2 import config_flag
+
+
+enabled = config_flag('mongodb_instrumentation')
+
+#Reply bytes are counted by encoding every reply again, which costs as
+#much as the reply is large
+count_bytes = config_flag('mongodb_instrumentation_bytes')
+
+#Operations slower than this many milliseconds are logged, with the
+#plan of their query when mongodb_slow_op_explain is set. The explain
+#runs on the thread of the operation
+slow_op_ms = float(tools.config.get('mongodb_slow_op_ms', 1000))
+slow_op_explain = config_flag('mongodb_slow_op_explain')
+
+#Upper bounds in milliseconds of the latency histogram buckets, the
+#last bucket holds the slower operations
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+_local = local()
+_stats = {}
+_stats_lock = Lock()
+_listeners = []
+
+
+def _active():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class OperationStats(object):
+    """Accumulated figures of the operations of a model and name"""
+
+    __slots__ = ('count', 'total_time', 'max_time', 'server_time',
+                 'round_trips', 'docs', 'bytes', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.server_time = 0.0
+        self.round_trips = 0
+        self.docs = 0
+        self.bytes = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, op):
+        self.count += 1
+        self.total_time += op.elapsed
+        self.max_time = max(self.max_time, op.elapsed)
+        self.server_time += op.server_time
+        self.round_trips += op.round_trips
+        self.docs += op.docs
+        self.bytes += op.bytes
+        self.buckets[bisect_left(BUCKETS, op.elapsed * 1000)] += 1
+
+    def percentile(self, fraction):
+        """Upper bound in milliseconds of the bucket holding the
+        fraction percentile, None past the last bucket"""
+        threshold = fraction * self.count
+        running = 0
+        for i, count in enumerate(self.buckets):
+            running += count
+            if count and running >= threshold:
+                return i < len(BUCKETS) and BUCKETS[i] or None
+        return None
+
+    def as_dict(self):
+        count = self.count or 1
+        return {
+            'count': self.count,
+            'avg_ms': self.total_time * 1000 / count,
+            'max_ms': self.max_time * 1000,
+            'p50_ms': self.percentile(0.5),
+            'p99_ms': self.percentile(0.99),
+            'server_ms': self.server_time * 1000,
+            'round_trips': self.round_trips,
+            'docs': self.docs,
+            'bytes': self.bytes,
+            'histogram': dict(zip(BUCKETS + ('inf',), self.buckets)),
+        }
+
+
+class Operation(object):
+    """A timed ORM operation, used as a context manager. The query it
+    runs can be attached with annotate for the slow operation log"""
+
+    def __init__(self, model, name):
+        self.model = model
+        self.name = name
+        self.collection = None
+        self.filter = None
+        self.sort = None
+        self.round_trips = 0
+        self.docs = 0
+        self.bytes = 0
+        self.server_time = 0.0
+        self.elapsed = 0.0
+        self._start = None
+
+    def __enter__(self):
+        _active().append(self)
+        self._start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time() - self._start
+        stack = _active()
+        if stack and stack[-1] is self:
+            stack.pop()
+        _record(self)
+        return False
+
+
+class _NoOperation(object):
+    """Operation standing in while instrumentation is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_OPERATION = _NoOperation()
+
+
+def operation(model, name):
+    """Context manager timing the operation name of model"""
+    if not enabled:
+        return _NO_OPERATION
+    return Operation(model, name)
+
+
+def instrumented(name):
+    """Decorator timing a method of a model as the operation name"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not enabled:
+                return func(self, *args, **kwargs)
+            with Operation(self._name, name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate(collection, spec, sort=None):
+    """Attach the query being run to the innermost operation"""
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        op = stack[-1]
+        op.collection = collection
+        op.filter = spec
+        op.sort = sort
+
+
+def _record(op):
+    key = (op.model, op.name)
+    with _stats_lock:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = _stats[key] = OperationStats()
+        stats.add(op)
+    for listener in _listeners:
+        try:
+            listener(op)
+        except Exception, e:
+            netsvc.Logger().notifyChannel('MongoDB', netsvc.LOG_ERROR,
+                'instrumentation listener %s failed: %s' % (listener, e))
+
+
+def add_listener(listener):
+    """Call listener(operation) for every finished operation"""
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+class CommandListener(monitoring.CommandListener):
+    """Accounts the MongoDB commands to the active operations of the
+    thread running them"""
+
+    def started(self, event):
+        for op in getattr(_local, 'stack', ()):
+            op.round_trips += 1
+
+    def succeeded(self, event):
+        ops = getattr(_local, 'stack', None)
+        if not ops:
+            return
+        reply = event.reply
+        cursor = reply.get('cursor')
+        if cursor:
+            docs = len(cursor.get('firstBatch', cursor.get('nextBatch', ())))
+        else:
+            docs = reply.get('n', 0)
+        size = count_bytes and len(BSON.encode(reply)) or 0
+        for op in ops:
+            op.docs += docs
+            op.bytes += size
+            op.server_time += event.duration_micros / 1000000.0
+
+    def failed(self, event):
+        for op in getattr(_local, 'stack', ()):
+            op.server_time += event.duration_micros / 1000000.0
+
+
+def explain_summary(collection, spec, sort=None):
+    """Stages of the winning plan of the query, like
+    'FETCH <- IXSCAN(id_1)'"""
+    #The explain is not accounted to the operations of the thread
+    stack, _local.stack = getattr(_local, 'stack', None), []
+    try:
+        plan = index_advisor.winning_plan(collection, spec, sort)
+    finally:
+        _local.stack = stack
+    if plan is None:
+        return 'not explained'
+    stages = []
+    while plan:
+        stage = plan.get('stage', '?')
+        if plan.get('indexName'):
+            stage += '(%s)' % plan['indexName']
+        stages.append(stage)
+        plan = plan.get('inputStage') or (plan.get('inputStages')
+                                          or [None])[0]
+    return ' <- '.join(stages)
+
+
+def log_slow_operation(op):
+    """Default listener, logs the operations slower than slow_op_ms"""
+    if not slow_op_ms or op.elapsed * 1000 < slow_op_ms:
+        return
+    msg = 'slow %s %s: %.1f ms (server %.1f ms), %s round trips, ' \
+          '%s docs, %s bytes' % (op.model, op.name, op.elapsed * 1000,
+                                 op.server_time * 1000, op.round_trips,
+                                 op.docs, op.bytes)
+    if op.collection is not None:
+        msg += ', filter %s, sort %s' % (op.filter, op.sort)
+        if slow_op_explain:
+            msg += ', plan %s' % explain_summary(op.collection, op.filter,
+                                                 op.sort)
+    netsvc.Logger().notifyChannel('MongoDB', netsvc.LOG_WARNING, msg)
+
+
+add_listener(log_slow_operation)
+
+
+def dump(model=None):
+    """Return {model: {operation: statistics}} of model or of all of
+    them"""
+    res = {}
+    with _stats_lock:
+        for (op_model, name), stats in _stats.iteritems():
+            if model is None or op_model == model:
+                res.setdefault(op_model, {})[name] = stats.as_dict()
+    return res
+
+
+def log_stats(model=None):
+    """Log the statistics of dump through netsvc"""
+    logger = netsvc.Logger()
+    for op_model, operations in sorted(dump(model).iteritems()):
+        for name, stats in sorted(operations.iteritems()):
+            logger.notifyChannel('MongoDB', netsvc.LOG_INFO,
+                '%s %s: %s ops, avg %.2f ms, p50 %s ms, p99 %s ms, '
+                'max %.2f ms, server %.1f ms, %s round trips, %s docs, '
+                '%s bytes' % (op_model, name, stats['count'],
+                              stats['avg_ms'], stats['p50_ms'],
+                              stats['p99_ms'], stats['max_ms'],
+                              stats['server_ms'], stats['round_trips'],
+                              stats['docs'], stats['bytes']))
+
+
+def reset():
+    with _stats_lock:
+        _stats.clear()
@@ -21,18 +21,293 @@
 ##############################################################################
 
 import tools
-from pymongo import MongoClient, MongoReplicaSetClient
-from pymongo.errors import AutoReconnect
+from pymongo import MongoClient, monitoring
+from pymongo.errors import AutoReconnect, ConnectionFailure
+from pymongo import read_preferences
+from pymongo.write_concern import WriteConcern
 from pymongo.read_preferences import ReadPreference
+import os
 import re
+import random
 import netsvc
 from osv.orm import except_orm
-from time import sleep
+from time import sleep, time
+from collections import OrderedDict
+from threading import BoundedSemaphore, Event, Lock, Thread
 
 
 logger = netsvc.Logger()
 
 
+def config_flag(key, default=False):
+    """Boolean value of the server option key"""
+    return str(tools.config.get(key, default)).lower() in ('1', 'true', 'yes')
+
+
+class LRUCache(object):
+    """Thread safe mapping bounded to size entries. The least recently
+    used entries are dropped first."""
+
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_like_cache = LRUCache(int(tools.config.get('mongodb_regex_cache_size',
+                                            1024)))
+
+
+def translate_like(value, ignore_case=False):
+    """Translate a LIKE pattern to a compiled regular expression and,
+    for case sensitive pure prefixes ('abc%'), the (lower, upper)
+    bounds of the equivalent index friendly range.
+
+    Patterns without '%' keep matching anywhere in the value. With
+    '%' wildcards the sides without a wildcard are anchored, so
+    'abc%' becomes '^abc' that MongoDB can resolve with an index.
+    Everything else is escaped. Translations are cached.
+    """
+    key = (value, ignore_case)
+    res = _like_cache.get(key)
+    if res is not None:
+        return res
+    regex = '.*'.join(re.escape(part) for part in value.split('%'))
+    if '%' in value:
+        if not value.startswith('%'):
+            regex = '^' + regex
+        if not value.endswith('%'):
+            regex = regex + '$'
+    #Leading and trailing '.*' are useless in an unanchored search
+    if regex.startswith('.*'):
+        regex = regex[2:]
+    if regex.endswith('.*'):
+        regex = regex[:-2]
+    bounds = None
+    prefix = value[:-1]
+    if (not ignore_case and prefix and value.endswith('%')
+            and '%' not in prefix):
+        last = ord(prefix[-1])
+        if last < 0x7f or (isinstance(prefix, unicode) and last < 0xd7ff):
+            upper = prefix[:-1] + (isinstance(prefix, unicode)
+                                   and unichr(last + 1) or chr(last + 1))
+            bounds = (prefix, upper)
+    res = (re.compile(regex, ignore_case and re.I or 0), bounds)
+    _like_cache.set(key, res)
+    return res
+
+
+def _like(field, value):
+    regex, bounds = translate_like(value)
+    if bounds:
+        return {field: {'$gte': bounds[0], '$lt': bounds[1]}}
+    return {field: {'$regex': regex}}
+
+
+#OpenERP configuration keys of the MongoClient pool options
+CLIENT_OPTIONS = [
+    ('mongodb_max_pool_size', 'maxPoolSize'),
+    ('mongodb_min_pool_size', 'minPoolSize'),
+    ('mongodb_wait_queue_timeout_ms', 'waitQueueTimeoutMS'),
+    ('mongodb_server_selection_timeout_ms', 'serverSelectionTimeoutMS'),
+    ('mongodb_connect_timeout_ms', 'connectTimeoutMS'),
+    ('mongodb_socket_timeout_ms', 'socketTimeoutMS'),
+]
+
+
+def backoff(attempt):
+    """Seconds to wait before the retry number attempt: exponential
+    with full jitter, capped to mongodb_backoff_max"""
+    base = float(tools.config.get('mongodb_backoff_base', 0.1))
+    cap = float(tools.config.get('mongodb_backoff_max', 5))
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+READ_PREFERENCES = {
+    'primary': read_preferences.Primary,
+    'primaryPreferred': read_preferences.PrimaryPreferred,
+    'secondary': read_preferences.Secondary,
+    'secondaryPreferred': read_preferences.SecondaryPreferred,
+    'nearest': read_preferences.Nearest,
+}
+
+#Smallest maxStalenessSeconds servers accept
+MIN_MAX_STALENESS = 90
+
+_read_preferences = {}
+
+
+def get_read_preference(mode, max_staleness=None):
+    """pymongo read preference of the mode name, with max_staleness
+    seconds of accepted replication lag (not applicable to primary)"""
+    if mode == 'primary':
+        max_staleness = None
+    else:
+        max_staleness = check_max_staleness(max_staleness)
+    key = (mode, max_staleness)
+    res = _read_preferences.get(key)
+    if res is None:
+        if mode not in READ_PREFERENCES:
+            raise except_orm('MongoDB read preference error',
+                             'Unknown read preference %s' % mode)
+        if mode == 'primary':
+            res = READ_PREFERENCES[mode]()
+        else:
+            res = READ_PREFERENCES[mode](max_staleness=max_staleness)
+        _read_preferences[key] = res
+    return res
+
+
+def check_max_staleness(max_staleness):
+    """max_staleness as the integer pymongo expects, -1 when not set.
+    Servers refuse less than MIN_MAX_STALENESS seconds, which pymongo
+    would only report once a server is selected"""
+    if not max_staleness or max_staleness in (-1, '-1'):
+        return -1
+    try:
+        res = int(max_staleness)
+    except (TypeError, ValueError):
+        raise except_orm('MongoDB read preference error',
+                         'Invalid max staleness %r' % (max_staleness,))
+    if res < MIN_MAX_STALENESS:
+        raise except_orm('MongoDB read preference error',
+                         'Max staleness must be at least %s seconds, '
+                         'not %s' % (MIN_MAX_STALENESS, res))
+    return res
+
+
+_write_concerns = {}
+
+
+def get_write_concern(options):
+    """pymongo WriteConcern of a dict of options like {'w': 1}"""
+    key = tuple(sorted(options.items()))
+    res = _write_concerns.get(key)
+    if res is None:
+        res = _write_concerns[key] = WriteConcern(**options)
+    return res
+
+
+class CircuitBreaker(object):
+    """Fails fast while the cluster is unavailable.
+
+    Opens after threshold consecutive failed operations, an operation
+    failing once it ran out of retries. Once reset_timeout
+    seconds have passed a call is let through to probe the cluster,
+    and any success closes it again.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        if self._opened_at is None:
+            return True
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time() - self._opened_at >= self.reset_timeout:
+                #Half open: let this call probe, the rest wait again
+                self._opened_at = time()
+                return True
+            return False
+
+    def success(self):
+        if self._failures or self._opened_at is not None:
+            with self._lock:
+                if self._opened_at is not None:
+                    logger.notifyChannel('MongoDB', netsvc.LOG_INFO,
+                                         'connection restored')
+                self._failures = 0
+                self._opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if (self._failures >= self.threshold
+                    and self._opened_at is None):
+                logger.notifyChannel('MongoDB', netsvc.LOG_ERROR,
+                                     'MongoDB unavailable after %s failures,'
+                                     ' failing fast for %ss'
+                                     % (self._failures, self.reset_timeout))
+                self._opened_at = time()
+
+
+class HeartbeatListener(monitoring.ServerHeartbeatListener):
+    """Feeds the circuit breaker with the driver server monitoring, so
+    it also opens and closes without application traffic. Only a
+    writable server closes it, a replica set without primary can not
+    serve the writes"""
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if getattr(event.reply, 'is_writable', False):
+            self.breaker.success()
+
+    def failed(self, event):
+        self.breaker.failure()
+
+
+class PendingInit(object):
+    """Model initialisation running in the background, at most as
+    many at once as slots allows"""
+
+    def __init__(self, name, func, slots):
+        self.name = name
+        self.func = func
+        self.slots = slots
+        self.error = None
+        self.done = Event()
+
+    def run(self):
+        try:
+            with self.slots:
+                self.func()
+        except Exception, e:
+            self.error = e
+            logger.notifyChannel('MongoDB', netsvc.LOG_ERROR,
+                                 'initialisation of %s failed: %s'
+                                 % (self.name, e))
+        finally:
+            self.done.set()
+
+
 class MDBConn(object):
 
     OPERATOR_MAPPING = {
@@ -46,13 +321,12 @@ class MDBConn(object):
         'in': lambda l1, l3: {l1: {'$in': l3}},
         'not in': lambda l1, l3: {l1: {'$nin': l3}},
 
-        'like': lambda l1, l3: {l1: {
-            '$regex': re.compile(l3.replace('%', '.*'))}},
+        'like': _like,
         'not like': lambda l1, l3: {l1: {
-        '$not': re.compile('%s' % l3.replace('%', '.*'))}},
-        'ilike': lambda l1, l3: {l1: re.compile(l3.replace('%', '.*'), re.I)},
+        '$not': translate_like(l3)[0]}},
+        'ilike': lambda l1, l3: {l1: translate_like(l3, True)[0]},
         'not ilike': lambda l1, l3: {l1: {
-        '$not': re.compile(l3.replace('%', '.*'), re.I)}},
+        '$not': translate_like(l3, True)[0]}},
         }
 
     def translate_domain(self, domain):
@@ -65,6 +339,8 @@ class MDBConn(object):
         {'name': {'$ne': 'ol'}}
 
         >>> translate_domain([('name', 'like', 'ol%')])
+        {'name': {'$gte': 'ol', '$lt': 'om'}}
+        >>> translate_domain([('name', 'like', '%ol')])
         {'name': {'$regex': <_sre.SRE_Pattern object at 0x...>}}
         >>> translate_domain([('name', 'not like', '%ol%')])
         {'name': {'$not': <_sre.SRE_Pattern object at 0x...>}}
@@ -92,15 +368,123 @@ class MDBConn(object):
                               ('name', 'ilike', '%ol%')])
         {'_id': {'$gt': 10, '$lt': 15},
          'name': <_sre.SRE_Pattern object at 0x...>}
+
+        >>> translate_domain(['|', ('name', '=', 'ol'), ('_id', '>', 10)])
+        {'$or': [{'name': 'ol'}, {'_id': {'$gt': 10}}]}
+        >>> translate_domain(['!', ('name', '=', 'ol')])
+        {'$nor': [{'name': 'ol'}]}
+        >>> translate_domain([('_id', '>', 10), ('_id', '>', 15)])
+        {'$and': [{'_id': {'$gt': 10}}, {'_id': {'$gt': 15}}]}
         """
-        new_domain = {}
-        for field, operator, value in domain:
-            clause = self.OPERATOR_MAPPING[operator](field, value)
-            if field in new_domain.keys():
-                new_domain[field].update(clause[field])
+        shape, values = self.domain_shape(domain)
+        return self.compile_domain(shape)(values)
+
+    def domain_shape(self, domain):
+        """Split a domain in its shape, made of the prefix operators
+        and the (field, operator) pair of every leaf, and the list of
+        the leaf values"""
+        shape = []
+        values = []
+        for item in domain:
+            if isinstance(item, basestring):
+                shape.append(item)
             else:
-                new_domain.update(clause)
-        return new_domain
+                field, operator, value = item
+                shape.append((field, operator))
+                values.append(value)
+        return tuple(shape), values
+
+    def compile_domain(self, shape):
+        """Return a function building the MongoDB filter of the domain
+        shape from the leaf values. Compiled shapes are cached."""
+        builder = self._domain_cache.get(shape)
+        if builder is None:
+            builder = self._compile_shape(shape)
+            self._domain_cache.set(shape, builder)
+        return builder
+
+    def _compile_shape(self, shape):
+        pos = [0]
+        leaves = [0]
+
+        def parse():
+            if pos[0] >= len(shape):
+                raise except_orm('MongoDB domain error',
+                                 'Missing operand in domain %s' % (shape,))
+            token = shape[pos[0]]
+            pos[0] += 1
+            if token == '!':
+                return ('!', [parse()])
+            if token in ('|', '&'):
+                return (token, [parse(), parse()])
+            if isinstance(token, basestring):
+                raise except_orm('MongoDB domain error',
+                                 'Unknown domain operator %s' % token)
+            field, operator = token
+            if operator not in self.OPERATOR_MAPPING:
+                raise except_orm('MongoDB domain error',
+                                 'Unsupported operator %s' % operator)
+            leaves[0] += 1
+            return ('leaf', (field, operator, leaves[0] - 1))
+
+        #Top level terms are implicitly joined with '&'
+        nodes = []
+        while pos[0] < len(shape):
+            nodes.append(parse())
+        return self._compile_node(('&', nodes))
+
+    def _compile_node(self, node):
+        kind, children = node
+        if kind == 'leaf':
+            field, operator, pos = children
+            mapping = self.OPERATOR_MAPPING[operator]
+            return lambda values: mapping(field, values[pos])
+        if kind == '!':
+            child = self._compile_node(children[0])
+            return lambda values: {'$nor': [child(values)]}
+        compiled = [self._compile_node(child)
+                    for child in self._flatten(kind, children)]
+        if len(compiled) == 1:
+            return compiled[0]
+        if kind == '|':
+            return lambda values: {'$or': [c(values) for c in compiled]}
+        return lambda values: self._merge_and([c(values) for c in compiled])
+
+    def _flatten(self, kind, children):
+        """a | (b | c) -> a | b | c"""
+        res = []
+        for child in children:
+            if child[0] == kind:
+                res.extend(self._flatten(kind, child[1]))
+            else:
+                res.append(child)
+        return res
+
+    def _merge_and(self, clauses):
+        """Join clauses in a single filter, merging the operators of
+        the same field when they do not clash and using $and for the
+        rest"""
+        res = {}
+        extra = []
+        for clause in clauses:
+            for key, cond in clause.iteritems():
+                if key not in res:
+                    res[key] = cond
+                    continue
+                current = res[key]
+                if (isinstance(current, dict) and isinstance(cond, dict)
+                        and not key.startswith('$')
+                        and all(k.startswith('$') for k in current)
+                        and all(k.startswith('$') for k in cond)
+                        and not set(current) & set(cond)):
+                    merged = current.copy()
+                    merged.update(cond)
+                    res[key] = merged
+                else:
+                    extra.append({key: cond})
+        if extra:
+            res = {'$and': [res] + extra}
+        return res
 
     @property
     def uri(self):
@@ -142,83 +526,139 @@ class MDBConn(object):
                                   int(tools.config['mongodb_port']))
         return uri
 
+    def client_options(self):
+        """MongoClient options read from the OpenERP configuration.
+        Only the configured ones are passed, pymongo defaults apply to
+        the rest."""
+        options = {}
+        for key, option in CLIENT_OPTIONS:
+            value = tools.config.get(key)
+            if value not in (None, False, ''):
+                options[option] = int(value)
+        tools.config['mongodb_replicaset'] = tools.config.get(
+            'mongodb_replicaset', False
+        )
+        if tools.config['mongodb_replicaset']:
+            options.update({'replicaSet': tools.config['mongodb_replicaset'],
+                            'read_preference':
+                                ReadPreference.PRIMARY_PREFERRED})
+        return options
+
     def mongo_connect(self):
         '''Connects to mongo'''
+        #Imported here, instrumentation imports config_flag from this
+        #module
+        import instrumentation
         try:
-            tools.config['mongodb_replicaset'] = tools.config.get(
-                'mongodb_replicaset', False
-            )
-            mongo_client = MongoClient
-            kwargs = {}
-            if tools.config['mongodb_replicaset']:
-                kwargs.update({'replicaSet': tools.config['mongodb_replicaset'],
-                               'read_preference': ReadPreference.PRIMARY_PREFERRED})
-                mongo_client = MongoReplicaSetClient
-
-            connection = mongo_client(self.uri, **kwargs)
+            kwargs = self.client_options()
+            kwargs['event_listeners'] = [HeartbeatListener(self.breaker),
+                                         instrumentation.CommandListener()]
+            connection = MongoClient(self.uri, **kwargs)
         except Exception, e:
             raise except_orm('MongoDB connection error', e)
         return connection
 
     def __init__(self):
         self._connection = None
+        self._pid = None
+        self._lock = Lock()
+        self._domain_cache = LRUCache(
+            int(tools.config.get('mongodb_domain_cache_size', 512)))
+        self.breaker = CircuitBreaker(
+            int(tools.config.get('mongodb_breaker_threshold', 5)),
+            float(tools.config.get('mongodb_breaker_reset', 30)))
+        #Models initialised in the background by defer_init
+        self.parallel_init = config_flag('mongodb_parallel_init')
+        #Set up every model again, ignoring the schema fingerprints
+        self.force_init = config_flag('mongodb_force_init')
+        self._init_slots = BoundedSemaphore(
+            int(tools.config.get('mongodb_init_workers', 4)))
+        self._pending_inits = {}
 
     @property
     def connection(self):
-        if self._connection is None:
-            self._connection = self.mongo_connect()
+        """The client shared by the whole process. It keeps its own
+        connection pool and reconnects by itself, so it is only
+        created again in a forked child."""
+        if self._connection is None or self._pid != os.getpid():
+            with self._lock:
+                if self._connection is None or self._pid != os.getpid():
+                    self._connection = self.mongo_connect()
+                    self._pid = os.getpid()
         return self._connection
 
-    def get_collection(self, collection):
+    def defer_init(self, collection, func):
+        """Run func, the initialisation of collection, in the
+        background. get_collection(collection) waits for it"""
+        pending = PendingInit(collection, func, self._init_slots)
+        self._pending_inits[collection] = pending
+        worker = Thread(target=pending.run,
+                        name='mongodb-init-%s' % collection)
+        worker.daemon = True
+        worker.start()
 
-        try:
-            db = self.connection[tools.config['mongodb_name']]
-            collection = db[collection]
-
-        except AutoReconnect as ar_e:
-            max_tries = 5
-            count = 0
-            while count < max_tries:
-                try:
-                    logger.notifyChannel('MongoDB', netsvc.LOG_WARNING,
-                                 'trying to reconnect...')
-                    con = self.mongo_connect()
-
-                    db = con[tools.config['mongodb_name']]
-                    collection = db[collection]
-                    break
-                except AutoReconnect:
-                    count += 1
-                    sleep(0.5)
-            if count == 4:
-                raise except_orm('MongoDB connection error', ar_e)
-        except Exception, e:
-            raise except_orm('MongoDB connection error', e)
+    def wait_init(self, collection):
+        """Wait for the background initialisation of collection"""
+        pending = self._pending_inits.get(collection)
+        if pending is None:
+            return
+        pending.done.wait()
+        self._pending_inits.pop(collection, None)
+        if pending.error is not None:
+            raise except_orm('MongoDB initialisation error', pending.error)
+
+    def get_collection(self, collection, read_preference=None,
+                       max_staleness=None, write_concern=None):
 
-        return collection
+        if self._pending_inits:
+            self.wait_init(collection)
+        db = self.get_db()
+        options = {}
+        if read_preference:
+            options['read_preference'] = get_read_preference(read_preference,
+                                                             max_staleness)
+        if write_concern:
+            options['write_concern'] = get_write_concern(write_concern)
+        if options:
+            return db.get_collection(collection, **options)
+        return db[collection]
 
     def get_db(self):
 
-        try:
-            db = self.connection[tools.config['mongodb_name']]
-        except AutoReconnect:
-            max_tries = 5
-            count = 0
-            while count < max_tries:
-                try:
-                    logger.notifyChannel('MongoDB', netsvc.LOG_WARNING,
-                                 'WARNING: MongoDB trying to reconnect...')
-                    con = self.mongo_connect()
-
-                    db = con[tools.config['mongodb_name']]
-                    break
-                except AutoReconnect:
-                    count += 1
-                    sleep(0.5)
-        except Exception, e:
-            raise except_orm('MongoDB connection error', e)
+        if not self.breaker.allow():
+            raise except_orm('MongoDB connection error',
+                             'MongoDB is unavailable, failing fast')
+        return self.run(lambda: self.connection[tools.config['mongodb_name']])
 
-        return db
+    def run(self, func, *args, **kwargs):
+        """Call func, retrying with exponential backoff and jitter
+        while the connection is lost. Only idempotent operations, like
+        queries, should be run this way."""
+        max_tries = int(tools.config.get('mongodb_max_tries', 5))
+        count = 0
+        while True:
+            try:
+                res = func(*args, **kwargs)
+            except AutoReconnect, e:
+                count += 1
+                #The breaker counts failed operations, not their retries
+                if count >= max_tries:
+                    self.breaker.failure()
+                    raise except_orm('MongoDB connection error', e)
+                if not self.breaker.allow():
+                    raise except_orm('MongoDB connection error', e)
+                delay = backoff(count)
+                logger.notifyChannel('MongoDB', netsvc.LOG_WARNING,
+                                     'connection lost, retrying in %.2fs: '
+                                     '%s' % (delay, e))
+                sleep(delay)
+            except ConnectionFailure, e:
+                self.breaker.failure()
+                raise except_orm('MongoDB connection error', e)
+            else:
+                #Also closes the breaker after a half open probe
+                self.breaker.success()
+                return res
 
     def end_request(self):
         return self.connection.end_request()
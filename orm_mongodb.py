@@ -24,16 +24,159 @@ from osv import orm, fields
 from osv.orm import except_orm
 import netsvc
 import re
+import hashlib
 import pymongo
-import gridfs
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+from tools import human_size
+from tools.translate import _
+from bson import BSON
 from bson.objectid import ObjectId
-from datetime import datetime
+from bson.son import SON
+from datetime import datetime, timedelta
+import time
 
 #mongodb stuff
 try:
-    from mongodb2 import mdbpool
+    from mongodb2 import mdbpool, LRUCache
 except ImportError:
     sys.stderr.write("ERROR: Import mongodb module\n")
+import id_allocator
+import gridfs_store
+import query_cache
+import index_advisor
+import instrumentation
+from instrumentation import instrumented
+
+
+DATE_FORMATS = {'date': '%Y-%m-%d', 'datetime': '%Y-%m-%d %H:%M:%S'}
+NUMERIC_TYPES = ('integer', 'float')
+#One term of an order: field or "field" and an optional direction
+ORDER_TERM = re.compile(r'^("?)([a-z0-9_]+)\1(?:\s+(asc|desc))?$', re.I)
+#Collection of the schema fingerprints of _auto_init, and version of
+#what it sets up, increase it to set up every model again
+FINGERPRINTS = 'schema_fingerprints'
+FINGERPRINT_VERSION = 1
+#Labels of the read_group date buckets
+GROUPBY_DATE_FORMATS = {'day': '%d %b %Y', 'month': '%B %Y', 'year': '%Y'}
+GROUPBY_DATE_PARTS = (('year', '$year'), ('month', '$month'),
+                      ('day', '$dayOfMonth'))
+#Accumulators of the column group_operator in read_group
+GROUP_OPERATORS = {'sum': '$sum', 'avg': '$avg', 'min': '$min', 'max': '$max'}
+#When searching datetime objects, string do not take time
+ONLY_DATE = re.compile("^[0-9]{4}-[0-9]{2}-[0-9]{2}$")
+
+
+def _date_writer(date_format):
+    def convert(value):
+        if not value:
+            return value
+        if ONLY_DATE.match(value):
+            return datetime.strptime(value, '%Y-%m-%d')
+        return datetime.strptime(value, date_format)
+    return convert
+
+
+def _date_reader(date_format):
+    #isoformat is several times faster than strftime and gives the
+    #same text: 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' once truncated
+    length = len(datetime(2000, 1, 1).strftime(date_format))
+    def convert(value):
+        if not value:
+            return value
+        return value.isoformat(' ')[:length]
+    return convert
+
+
+class ModelSchema(object):
+    """Immutable description of the columns of a model, computed once
+    instead of scanning _columns on every call.
+
+    write_converters maps every column to the callable preparing its
+    values for MongoDB (None when stored as is), read_converters maps
+    the columns needing a conversion back to theirs.
+    """
+
+    __slots__ = ('columns', 'size', 'column_types', 'date_fields',
+                 'bool_fields', 'numeric_fields', 'gridfs_fields',
+                 'write_converters', 'read_converters')
+
+    def __init__(self, columns):
+        column_types = dict((key, val._type)
+                            for key, val in columns.iteritems())
+        write_converters = {}
+        read_converters = {}
+        for key, val in columns.iteritems():
+            if val._type in DATE_FORMATS:
+                write_converters[key] = _date_writer(DATE_FORMATS[val._type])
+                read_converters[key] = _date_reader(DATE_FORMATS[val._type])
+            elif val._type in NUMERIC_TYPES:
+                write_converters[key] = val._symbol_set[1]
+            else:
+                write_converters[key] = None
+        init = super(ModelSchema, self).__setattr__
+        init('columns', columns)
+        init('size', len(columns))
+        init('column_types', column_types)
+        init('date_fields', frozenset(key for key, ttype
+                                      in column_types.iteritems()
+                                      if ttype in DATE_FORMATS))
+        init('bool_fields', frozenset(key for key, ttype
+                                      in column_types.iteritems()
+                                      if ttype == 'boolean'))
+        init('numeric_fields', frozenset(key for key, ttype
+                                         in column_types.iteritems()
+                                         if ttype in NUMERIC_TYPES))
+        init('gridfs_fields', frozenset(key for key, val
+                                        in columns.iteritems()
+                                        if val._type == 'binary'
+                                        and getattr(val, 'gridfs', False)))
+        init('write_converters', write_converters)
+        init('read_converters', read_converters)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ModelSchema is immutable')
+
+    def matches(self, columns):
+        """Whether the schema still describes columns"""
+        return self.columns is columns and self.size == len(columns)
+
+
+class ReadPlan(object):
+    """Post processing of the documents read for a list of fields,
+    computed once per model and fields.
+
+    fields_pre are the stored fields to fetch, steps the (field,
+    converter) pairs applied to the non empty values of every document,
+    gridfs_fields the binary fields read in batch from GridFS and
+    function_todo the function fields grouped by _multi.
+    """
+
+    __slots__ = ('schema', 'fields_pre', 'steps', 'gridfs_fields',
+                 'function_todo')
+
+    def __init__(self, model, schema, fields_to_read):
+        columns = model._columns
+        # All non inherited fields for which the attribute
+        # whose name is in load is True
+        self.fields_pre = [f for f in fields_to_read if
+                              f == model.CONCURRENCY_CHECK_FIELD
+                           or (f in columns and getattr(columns[f],
+                                                        '_classic_write'))
+                          ]
+        steps = []
+        for f in self.fields_pre:
+            if f in schema.read_converters:
+                steps.append((f, schema.read_converters[f]))
+        todo = {}
+        for f in fields_to_read:
+            if f in columns and isinstance(columns[f], fields.function):
+                todo.setdefault(columns[f]._multi, []).append(f)
+        self.schema = schema
+        self.steps = tuple(steps)
+        self.gridfs_fields = tuple(f for f in self.fields_pre
+                                   if f in schema.gridfs_fields)
+        self.function_todo = tuple(todo.items())
 
 
 class orm_mongodb(orm.orm_template):
@@ -41,186 +184,373 @@ class orm_mongodb(orm.orm_template):
     _protected = ['read', 'write', 'create', 'default_get', 'perm_read',
                   'unlink', 'fields_get', 'fields_view_get', 'search',
                   'name_get', 'distinct_field_get', 'name_search', 'copy',
-                  'import_data', 'search_count', 'exists']
+                  'import_data', 'search_count', 'exists', 'create_many',
+                  'read_iter', 'write_many', 'search_read', 'read_group']
 
     _inherit_fields = {}
 
+    #ModelSchema of _columns, see get_schema
+    _schema = None
+
+    #Number of documents sent to MongoDB in each insert_many
+    #call of create_many
+    _insert_batch_size = 1000
+
+    #Number of UpdateOne operations sent to MongoDB in each
+    #bulk_write call of write_many
+    _write_batch_size = 1000
+
+    #When set, ids are leased from the counters collection in blocks
+    #of this size and handed out locally by each process (hi/lo).
+    #Ids stay unique but unused ids of a block are lost on restart
+    _id_block_size = 0
+
+    #Maximum number of ids sent in each {'id': {'$in': ids}} query
+    #of read. Larger reads are split and processed chunk by chunk
+    _read_chunk_size = 1000
+
+    #Filtered search counts stop at this number when set
+    _count_limit = 0
+
+    #Seconds search counts are cached. Changes made by this process
+    #invalidate the cache, changes made by other processes are seen
+    #once the entry expires
+    _count_cache_ttl = 0
+
+    #Read binary gridfs fields as gridfs_store.LazyFile proxies that
+    #stream the content on demand instead of loading it in memory.
+    #Can be set per call with context['gridfs_lazy']
+    _gridfs_lazy = False
+
+    #Store identical binary gridfs contents once, shared through a
+    #reference count on fs.files (see gridfs_store.put)
+    _gridfs_dedup = False
+
+    #GridFS files released per batch of queries on unlink, and whether
+    #they are released on a background worker so unlink does not wait
+    _gridfs_cleanup_batch_size = 1000
+    _gridfs_async_cleanup = False
+
+    #Read preference of searches and reads ('primary',
+    #'primaryPreferred', 'secondary', 'secondaryPreferred' or
+    #'nearest') and the maximum replication lag in seconds accepted
+    #for secondaries, at least 90. Overridden per call by
+    #context['read_preference'] and context['max_staleness_seconds']
+    _read_preference = None
+    _read_max_staleness = None
+
+    #Write concern of create, write and unlink, as keyword arguments of
+    #pymongo WriteConcern: {'w': 0} does not wait for any
+    #acknowledgement (errors are not reported), {'w': 1} waits for the
+    #primary, {'w': 'majority', 'j': True} for a journaled majority.
+    #The client default (acknowledged) when not set
+    _write_concern = None
+
+    #Keep search ids and read documents in a per process cache,
+    #bounded to _query_cache_size entries and _query_cache_bytes of
+    #estimated size. Entries are dropped when the generation of the
+    #model, increased by create, write and unlink of any process,
+    #changes, which costs a small query per search and read
+    _query_cache = False
+    _query_cache_size = 10000
+    _query_cache_bytes = 64 * 1024 * 1024
+
+    #Create the compound indexes index_advisor recommends for the
+    #searches of the model explained as collection scans or in memory
+    #sorts, once run mongodb_index_advisor_min_count times
+    _auto_indexes = False
+
     def _auto_init(self, cr, context=None):
+        """Set up the collection of the model: counters document, id
+        and select indexes and default values of existing documents.
+
+        What was set up is kept as a fingerprint in the
+        schema_fingerprints collection, an unchanged model is not set
+        up again and a changed one only gets what is new. With
+        mongodb_parallel_init the MongoDB part runs in the background
+        and the first use of the collection waits for it.
+        """
         self._field_create(cr, context=context)
+        self._schema = ModelSchema(self._columns)
+
+        fingerprint = self._schema_fingerprint()
+        fingerprints = mdbpool.get_db()[FINGERPRINTS]
+        previous = mdbpool.run(fingerprints.find_one, {'_id': self._table})
+        if previous and previous['hash'] == fingerprint['hash'] \
+                and not mdbpool.force_init:
+            return
+        previous = not mdbpool.force_init and previous or {}
+
+        #Default values are computed here, they may need the cursor
+        new_defaults = [f for f in fingerprint['defaults']
+                        if f not in previous.get('defaults', [])]
+        def_values = {}
+        if new_defaults:
+            def_values = self.default_get(cr, 1, new_defaults)
+
+        init = lambda: self._init_collection(previous, fingerprint,
+                                             def_values)
+        if mdbpool.parallel_init:
+            mdbpool.defer_init(self._table, init)
+        else:
+            init()
+
+    def _init_collection(self, previous, fingerprint, def_values):
+        """MongoDB part of _auto_init, the difference between the
+        previous fingerprint and fingerprint"""
         logger = netsvc.Logger()
 
+        #Not get_collection, which waits for this init
         db = mdbpool.get_db()
+        collection = db[self._table]
 
-        #Create the model counters document in order to
-        #have incremental ids the way postgresql does
-        collection = db['counters']
-
-        if not collection.find({'_id': self._table}).count():
-            vals = {'_id': self._table,
-                    'counter': 1}
-            collection.save(vals)
+        try:
+            if not previous:
+                #Create the model counters document in order to
+                #have incremental ids the way postgresql does
+                db['counters'].update_one({'_id': self._table},
+                                          {'$setOnInsert': {'counter': 1}},
+                                          upsert=True)
+                #Create index for the id field
+                collection.create_index([('id', pymongo.ASCENDING)],
+                                        unique=True)
+
+            # Create auto indexs if field has select=True in field definition
+            # like PostgreSQL
+            for field_name in fingerprint['select']:
+                if field_name not in previous.get('select', []):
+                    collection.create_index(field_name)
+        except OperationFailure, e:
+            raise except_orm('MongoDB create id field index error', e)
 
-        collection = db[self._table]
-        #Create index for the id field
-        collection.ensure_index([('id', pymongo.ASCENDING)],
-                                deprecated_unique=None,
-                                ttl=300,
-                                unique=True)
-
-        # Create auto indexs if field has select=True in field definition
-        # like PostgreSQL
-        created_idx = [
-            x['key'][0][0] for x in collection.index_information().values()
-                if 'key' in x and len(x['key']) == 1
-        ]
-        for field_name, field_obj in self._columns.iteritems():
-            if getattr(field_obj, 'select', False):
-                if field_name not in created_idx:
-                    collection.ensure_index(field_name)
-
-        if db.error():
-            raise except_orm('MongoDB create id field index error', db.error())
         #Update docs with new default values if they do not exist
         #If we find at least one document with this field
         #we assume that the field is present in the collection
         def_fields = filter(lambda a: not collection.find_one(
                                           {a: {'$exists': True}}),
-                                          self._defaults.keys())
+                                          def_values.keys())
         if len(def_fields):
             logger.notifyChannel('orm', netsvc.LOG_INFO,
                                  'setting default value for \
                                   %s of collection %s' % (def_fields,
                                                           self._table))
-            def_values = self.default_get(cr, 1, def_fields)
-            collection.update({},
-                              {'$set': def_values},
-                              upsert=False,
-                              manipulate=False,
-                              safe=True,
-                              multi=True)
-
-        if db.error():
-            raise except_orm('MongoDB update defaults error', db.error())
+            try:
+                collection.update_many({}, {'$set': dict(
+                                (f, def_values[f]) for f in def_fields)})
+            except OperationFailure, e:
+                raise except_orm('MongoDB update defaults error', e)
+
+        db[FINGERPRINTS].replace_one({'_id': self._table}, fingerprint,
+                                     upsert=True)
+
+    def _schema_fingerprint(self):
+        """What _auto_init sets up for the model, with its hash"""
+        columns = dict((key, val._type)
+                       for key, val in self._columns.iteritems())
+        select = sorted(key for key, val in self._columns.iteritems()
+                        if getattr(val, 'select', False))
+        defaults = sorted(self._defaults.keys())
+        digest = hashlib.sha1(repr((FINGERPRINT_VERSION,
+                                    sorted(columns.items()),
+                                    select, defaults))).hexdigest()
+        return {'_id': self._table, 'hash': digest, 'columns': columns,
+                'select': select, 'defaults': defaults}
 
     def __init__(self, cr):
         super(orm_mongodb, self).__init__(cr)
+        self._count_cache = {}
+        self._read_plans = LRUCache(256)
+        self._orders = LRUCache(128)
+        self._result_cache = query_cache.QueryCache(self._query_cache_size,
+                                                    self._query_cache_bytes)
         cr.execute('delete from wkf_instance where res_type=%s', (self._name,))
 
+    def get_schema(self):
+        """Return the schema descriptor of the model, rebuilding it
+        when _columns has been replaced or changed size"""
+        schema = self._schema
+        if schema is None or not schema.matches(self._columns):
+            schema = self._schema = ModelSchema(self._columns)
+        return schema
+
     def get_date_fields(self):
-        return [key for key, val in self._columns.iteritems()
-                      if val._type in ('date', 'datetime')]
+        return self.get_schema().date_fields
 
     def get_bool_fields(self):
-        return [key for key, val in self._columns.iteritems()
-                      if val._type in ('boolean')]
+        return self.get_schema().bool_fields
 
     def get_binary_gridfs_fields(self):
-        return [key for key, val in self._columns.iteritems()
-                      if val._type in ('binary')
-                         and getattr(val, 'gridfs', False)]
+        return self.get_schema().gridfs_fields
 
-    def transform_binary_gridfs_field(self, field, value, action):
+    def transform_binary_gridfs_field(self, field, value, action, refs=1):
         if not value:
             return value
-        fs = gridfs.GridFS(mdbpool.get_db(), collection='fs')
         if action == 'read':
             objectid = ObjectId(value)
-            if fs.exists(objectid):
-                value = fs.get(objectid).read()
-            else:
-                value = ''
-            return value
+            files = gridfs_store.read_files(mdbpool.get_db(), [objectid])
+            return files.get(objectid, '')
         elif action == 'write':
-            _id = fs.put(value)
+            _id = gridfs_store.put(mdbpool.get_db(), value,
+                                   self._gridfs_dedup, refs)
             return str(_id)
 
-    def read_binary_gridfs_fields(self, fields, vals):
+    @instrumented('gridfs_read')
+    def read_binary_gridfs_fields(self, fields, vals, context=None):
+        if not context:
+            context = {}
         binary_fields = self.get_binary_gridfs_fields()
-        binary_fields_to_read = list(set(fields) & set(binary_fields))
-        if binary_fields:
-            for val in vals:
-                for binary_field in binary_fields_to_read:
-                    val[binary_field] = self.transform_binary_gridfs_field(
-                        binary_field, val[binary_field], 'read'
-                    )
-
-    def write_binary_gridfs_fields(self, val):
+        binary_fields_to_read = binary_fields.intersection(fields)
+        if not binary_fields_to_read:
+            return
+        if context.get('bin_size', False):
+            return self.read_binary_gridfs_sizes(binary_fields_to_read, vals)
+        lazy = context.get('gridfs_lazy', self._gridfs_lazy)
+        oids = gridfs_store.to_objectids(val.get(f) for val in vals
+                                                    for f in
+                                                    binary_fields_to_read)
+        files = gridfs_store.read_files(mdbpool.get_db(), oids, lazy)
+        for val in vals:
+            for binary_field in binary_fields_to_read:
+                oid = val.get(binary_field)
+                if oid:
+                    val[binary_field] = files.get(ObjectId(oid), '')
+
+    @instrumented('gridfs_sizes')
+    def read_binary_gridfs_sizes(self, fields, vals):
+        """bin_size values of the binary fields from the fs.files
+        metadata, with a single query and no content download"""
+        oids = gridfs_store.to_objectids(val.get(f) for val in vals
+                                                    for f in fields)
+        sizes = gridfs_store.file_sizes(mdbpool.get_db(), oids)
+        for val in vals:
+            for binary_field in fields:
+                oid = val.get(binary_field)
+                if oid:
+                    size = sizes.get(ObjectId(oid))
+                    val[binary_field] = size and human_size(size) or ''
+
+    @instrumented('gridfs_write')
+    def write_binary_gridfs_fields(self, val, refs=1):
+        """Store the binary gridfs values of val in GridFS, each file
+        referenced by refs records"""
         binary_fields = self.get_binary_gridfs_fields()
-        fields = val.keys()
-        binary_fields_to_write = list(set(fields) & set(binary_fields))
+        binary_fields_to_write = binary_fields.intersection(val)
         if binary_fields_to_write:
             for binary_field in binary_fields_to_write:
                 val[binary_field] = self.transform_binary_gridfs_field(
-                    binary_field, val[binary_field], 'write'
+                    binary_field, val[binary_field], 'write', refs
                 )
 
     def unlink_binary_gridfs_fields(self, collection, ids):
-        binary_fields = self.get_binary_gridfs_fields()
+        self.release_binary_gridfs_files(
+            collection, self.get_binary_gridfs_oids(collection, ids))
+
+    def get_binary_gridfs_oids(self, collection, ids):
+        """ObjectIds stored in the binary gridfs fields of ids, one per
+        value"""
+        return self.get_binary_gridfs_refs(
+                    collection, ids, self.get_binary_gridfs_fields())[1]
+
+    @instrumented('gridfs_oids')
+    def get_binary_gridfs_refs(self, collection, ids, binary_fields):
+        """Return the existing ids among ids and the ObjectIds stored
+        in their binary_fields, one per value"""
+        found = []
+        oids = []
         if binary_fields:
-            fs = gridfs.GridFS(mdbpool.get_db(), collection='fs')
-            mongo_cr = collection.find({'id': {'$in': ids}}, binary_fields)
-            res = [x for x in mongo_cr]
-            for item in res:
+            mongo_cr = lambda: collection.find({'id': {'$in': ids}},
+                                               ['id'] + list(binary_fields))
+            for item in mdbpool.run(lambda: [x for x in mongo_cr()]):
+                found.append(int(item['id']))
                 for binary_field in binary_fields:
                     oid = item.get(binary_field, False)
-                    if not oid:
-                        continue
-                    objectid = ObjectId(oid)
-                    if fs.exists(objectid):
-                        fs.delete(objectid)
+                    if oid:
+                        oids.append(ObjectId(oid))
+        return found, oids
+
+    @instrumented('gridfs_release')
+    def release_binary_gridfs_files(self, collection, oids):
+        """Release the GridFS files of oids in batches, on the
+        background cleanup worker with _gridfs_async_cleanup.
+
+        Files stored before reference counting have no refcount and one
+        may be shared by all the records written at once: those still
+        held by a record of collection are kept."""
+        if not oids:
+            return
+        legacy = mdbpool.run(gridfs_store.legacy_files, mdbpool.get_db(),
+                             oids)
+        if legacy:
+            binary_fields = self.get_binary_gridfs_fields()
+            values = [str(oid) for oid in legacy]
+            mongo_cr = lambda: collection.find(
+                        {'$or': [{binary_field: {'$in': values}}
+                                 for binary_field in binary_fields]},
+                        list(binary_fields))
+            held = set()
+            for item in mdbpool.run(lambda: [x for x in mongo_cr()]):
+                for binary_field in binary_fields:
+                    if item.get(binary_field):
+                        held.add(ObjectId(item[binary_field]))
+            oids = [oid for oid in oids if oid not in held]
+            if not oids:
+                return
+        if self._gridfs_async_cleanup:
+            gridfs_store.release_many_async(mdbpool.get_db(), oids,
+                                            self._gridfs_cleanup_batch_size)
+        else:
+            gridfs_store.release_many(mdbpool.get_db(), oids,
+                                      self._gridfs_cleanup_batch_size)
 
     def transform_date_field(self, field, value, action):
 
-        if not value:
-            return value
-
-        if self._columns[field]._type == 'date':
-            date_format = '%Y-%m-%d'
-        elif self._columns[field]._type == 'datetime':
-            date_format = '%Y-%m-%d %H:%M:%S'
-
+        schema = self.get_schema()
         if action == 'read':
-            return value.strftime(date_format)
+            return schema.read_converters[field](value)
         elif action == 'write':
-            #When searching datetime objects, string do not take time
-            only_date = re.compile("^[0-9]{4}-[0-9]{2}-[0-9]{2}$")
-            if only_date.match(value):
-                date_format = '%Y-%m-%d'
-            return datetime.strptime(value, date_format)
+            return schema.write_converters[field](value)
 
     def read_date_fields(self, fields, vals):
-        date_fields = self.get_date_fields()
-        date_fields_to_read = list(set(fields) & set(date_fields))
+        schema = self.get_schema()
+        date_fields_to_read = schema.date_fields.intersection(fields)
         if date_fields_to_read:
+            converters = [(date_field, schema.read_converters[date_field])
+                          for date_field in date_fields_to_read]
             for val in vals:
-                for date_field in date_fields_to_read:
+                for date_field, convert in converters:
                     if date_field not in val:
                         continue
-                    val[date_field] = self.transform_date_field(date_field,
-                                                            val[date_field],
-                                                                'read')
+                    val[date_field] = convert(val[date_field])
 
     def search_trans_fields(self, args):
         date_fields = self.get_date_fields()
         bool_fields = self.get_bool_fields()
         for arg in args:
+            #Skip the domain operators '|', '&' and '!'
+            if isinstance(arg, basestring):
+                continue
+            # Implement exact match for fields char which defaults to ilike
+            field = self._columns.get(arg[0])
+            if getattr(field, 'exact_match', False) and arg[1] == 'ilike':
+                arg[1] = '='
+                arg[2] = arg[2].strip('%')
             if arg[0] in date_fields:
                 arg[2] = self.transform_date_field(arg[0],
                                                    arg[2],
                                                    'write')
-            if arg[0] in bool_fields:
+            #None searches the null and missing values
+            if arg[0] in bool_fields and arg[2] is not None:
                 arg[2] = bool(arg[2])
 
     def preformat_write_fields(self, vals):
 
+        converters = self.get_schema().write_converters
         for key, value in vals.iteritems():
             if key == 'id':
                 continue
-            if self._columns[key]._type in ('date', 'datetime'):
-                vals[key] = self.transform_date_field(key, value, 'write')
-            elif self._columns[key]._type in ('int', 'float'):
-                ss = self._columns[key]._symbol_set
-                vals[key] = ss[1](value)
+            convert = converters[key]
+            if convert is not None:
+                vals[key] = convert(value)
 
     def read(self, cr, user, ids, fields=None, context=None,
              load='_classic_read'):
@@ -236,90 +566,173 @@ class orm_mongodb(orm.orm_template):
             select = [ids]
         result = self._read_flat(cr, user, select, fields, context, load)
 
-        for r in result:
-            for key, v in r.items():
-                #remove the '_id' field from the response
-                if key == '_id':
-                    del r[key]
-                    continue
-                #WTF. id field is not always readed as int
-                if key == 'id':
-                    r[key] = int(v)
-                    continue
-                if v is None:
-                    r[key] = False
-                else:
-                    continue
-
         if isinstance(ids, (int, long)):
             return result and result[0] or False
         return result
 
+    def read_iter(self, cr, user, ids, fields=None, context=None,
+                  load='_classic_read'):
+        """Generator variant of read. Records are read and post
+        processed in chunks of _read_chunk_size ids so memory usage
+        does not depend on the number of ids"""
+
+        if not context:
+            context = {}
+        self.pool.get('ir.model.access').check(cr, user, self._name,
+                                                'read', context=context)
+        if not fields:
+            fields = self._columns.keys()
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        for result in self._read_flat_chunks(cr, user, ids, fields,
+                                             context, load):
+            for r in result:
+                yield r
+
     def _read_flat(self, cr, user, ids, fields_to_read, context=None,
                    load='_classic_read'):
 
-        collection = mdbpool.get_collection(self._table)
+        res = []
+        for chunk in self._read_flat_chunks(cr, user, ids, fields_to_read,
+                                            context, load):
+            res.extend(chunk)
+        return res
+
+    def _read_flat_chunks(self, cr, user, ids, fields_to_read, context=None,
+                          load='_classic_read'):
+        """Yield the records of ids in post processed chunks of
+        _read_chunk_size ids, keeping the $in queries small"""
+
+        if not ids:
+            return
+        chunk_size = max(int(self._read_chunk_size), 1)
+        for start in xrange(0, len(ids), chunk_size):
+            yield self._read_flat_chunk(cr, user,
+                                        ids[start:start + chunk_size],
+                                        fields_to_read, context, load)
+
+    @instrumented('read')
+    def _read_flat_chunk(self, cr, user, ids, fields_to_read, context=None,
+                         load='_classic_read'):
 
         if not context:
             context = {}
         if not ids:
             return []
+        collection = self.get_read_collection(context)
 
         if fields_to_read is None:
             fields_to_read = self._columns.keys()
 
-        # All non inherited fields for which the attribute
-        # whose name is in load is True
-        fields_pre = [f for f in fields_to_read if
-                           f == self.CONCURRENCY_CHECK_FIELD
-                        or (f in self._columns and getattr(self._columns[f],
-                                                           '_classic_write'))
-                     ]
-
+        plan = self.get_read_plan(fields_to_read)
         res = []
-        if len(fields_pre):
-            order = self._compute_order(cr, user)
-            mongo_cr = collection.find({'id': {'$in': ids}},
-                                       fields_pre + ['id'],
-                                       sort=order)
-            res = [x for x in mongo_cr]
+        if len(plan.fields_pre):
+            #No server side sort for a lookup by id, the documents are
+            #put back in the order of ids instead
+            docs = self._read_documents(collection, ids, plan.fields_pre)
+            res = []
+            for record_id in ids:
+                doc = docs.pop(int(record_id), None)
+                if doc is not None:
+                    res.append(doc)
         else:
             res = map(lambda x: {'id': x}, ids)
-        #Post process date and datetime fields
-        self.read_date_fields(fields_to_read, res)
-        self.read_binary_gridfs_fields(fields_to_read, res)
-        # Function fields
-        fields_function = [
-            f for f in fields_to_read
-                if f in self._columns
-                    and isinstance(self._columns[f], fields.function)
-        ]
-        todo = {}
-        for f in fields_function:
-            todo.setdefault(self._columns[f]._multi, [])
-            todo[self._columns[f]._multi].append(f)
-        for key,val in todo.items():
+        self.apply_read_plan(cr, user, plan, ids, res, context)
+        return res
+
+    def _read_documents(self, collection, ids, fields_pre):
+        """Return {id: document} of ids with fields_pre, taken from
+        the query cache when the model uses it"""
+
+        cache, generation = self.get_query_cache()
+        docs = {}
+        missing = ids
+        if cache is not None:
+            fields_key = tuple(fields_pre)
+            missing = []
+            for record_id in ids:
+                doc = cache.get(('read', int(record_id), fields_key))
+                if doc is None:
+                    missing.append(record_id)
+                else:
+                    #Post processing changes the documents in place
+                    docs[int(record_id)] = dict(doc)
+        if not missing:
+            return docs
+        mongo_cr = lambda: collection.find({'id': {'$in': missing}},
+                                           fields_pre + ['id'],
+                                           batch_size=len(missing))
+        for doc in mdbpool.run(lambda: [x for x in mongo_cr()]):
+            record_id = int(doc['id'])
+            if cache is not None:
+                cache.set(('read', record_id, fields_key), doc,
+                          len(BSON.encode(doc)), generation)
+                doc = dict(doc)
+            docs[record_id] = doc
+        return docs
+
+    def get_read_plan(self, fields_to_read):
+        """Return the ReadPlan of fields_to_read, built once and kept
+        until the schema of the model changes"""
+        schema = self.get_schema()
+        key = tuple(fields_to_read)
+        plan = self._read_plans.get(key)
+        if plan is None or plan.schema is not schema:
+            plan = ReadPlan(self, schema, fields_to_read)
+            self._read_plans.set(key, plan)
+        return plan
+
+    def apply_read_plan(self, cr, user, plan, ids, res, context=None):
+        """Post process the documents res read from MongoDB in a
+        single pass: drop '_id', cast 'id', convert the stored values
+        and turn None into False. Function fields are computed after."""
+
+        if plan.gridfs_fields:
+            self.read_binary_gridfs_fields(plan.gridfs_fields, res, context)
+        steps = plan.steps
+        with instrumentation.operation(self._name, 'convert'):
+            for doc in res:
+                doc.pop('_id', None)
+                #WTF. id field is not always readed as int
+                doc['id'] = int(doc['id'])
+                for field, convert in steps:
+                    value = doc.get(field)
+                    if value:
+                        doc[field] = convert(value)
+                for key in [key for key, value in doc.iteritems()
+                            if value is None]:
+                    doc[key] = False
+        if plan.function_todo:
+            with instrumentation.operation(self._name, 'function_fields'):
+                self._compute_function_fields(cr, user, plan, ids, res,
+                                              context)
+
+    def _compute_function_fields(self, cr, user, plan, ids, res,
+                                 context=None):
+        """Compute the function fields of plan into the records res"""
+        for key, val in plan.function_todo:
             if key:
                 res2 = self._columns[val[0]].get(cr, self, ids, val, user,
                                                  context=context, values=res)
                 for pos in val:
                     for record in res:
-                        record[pos] = res2[record['id']][pos]
+                        value = res2[record['id']][pos]
+                        record[pos] = False if value is None else value
             else:
                 for f in val:
                     res2 = self._columns[f].get(cr, self, ids, f, user,
                                                 context=context, values=res)
                     for record in res:
                         if res2 and (record['id'] in res2):
-                            record[f] = res2[record['id']]
+                            value = res2[record['id']]
+                            record[f] = False if value is None else value
                         else:
                             record[f] = []
-        return res
 
+    @instrumented('write')
     def write(self, cr, user, ids, vals, context=None):
 
-        db = mdbpool.get_db()
-        collection = mdbpool.get_collection(self._table)
+        collection = self.get_write_collection()
         vals = vals.copy()
 
         if not ids:
@@ -329,25 +742,112 @@ class orm_mongodb(orm.orm_template):
                                                'write', context=context)
         #Pre process date and datetime fields
         self.preformat_write_fields(vals)
-        self.write_binary_gridfs_fields(vals)
+        #Every record written references the new GridFS files and
+        #releases the files it referenced before
+        binary_fields = self.get_binary_gridfs_fields().intersection(vals)
+        old_oids = []
+        if binary_fields:
+            found, old_oids = self.get_binary_gridfs_refs(collection, ids,
+                                                          binary_fields)
+            if found:
+                self.write_binary_gridfs_fields(vals, len(found))
+            else:
+                for binary_field in binary_fields:
+                    del vals[binary_field]
 
         #Log access
         vals.update({'write_uid': user,
                      'write_date': datetime.now(),
                     })
 
-        #bulk update with modifiers, and safe mode
-        collection.update({'id': {'$in': ids}},
-                          {'$set': vals},
-                          False, False, True, True)
-
-        if db.error():
-            raise except_orm('MongoDB update error', db.error())
+        #bulk update with modifiers, acknowledged as set by
+        #_write_concern
+        try:
+            collection.update_many({'id': {'$in': ids}}, {'$set': vals})
+        except OperationFailure, e:
+            raise except_orm('MongoDB update error', e)
+        finally:
+            self._invalidate_caches()
+        self.release_binary_gridfs_files(collection, old_oids)
 
         return True
 
+    @instrumented('write_many')
+    def write_many(self, cr, user, vals_by_id, context=None):
+        """Write different values to several records, {id: vals, ...},
+        with one access check and unordered bulk writes of
+        _write_batch_size updates.
+        Returns {'matched': n, 'modified': n} aggregated over the
+        batches, or None when _write_concern does not acknowledge
+        writes.
+        """
+        res = {'matched': 0, 'modified': 0}
+        if not vals_by_id:
+            return res
+        collection = self.get_write_collection()
+
+        self.pool.get('ir.model.access').check(cr, user, self._name,
+                                               'write', context=context)
+        #Dict keys are strings when called through XML-RPC
+        vals_by_id = dict((int(record_id), vals)
+                          for record_id, vals in vals_by_id.iteritems())
+        #The records written release the GridFS files they referenced
+        binary_fields = self.get_binary_gridfs_fields()
+        binary_ids = [record_id for record_id, vals in vals_by_id.iteritems()
+                      if binary_fields.intersection(vals)]
+        found = set()
+        old_oids = []
+        if binary_ids:
+            docs = mdbpool.run(lambda: list(collection.find(
+                                {'id': {'$in': binary_ids}},
+                                ['id'] + list(binary_fields))))
+            for doc in docs:
+                record_id = int(doc['id'])
+                found.add(record_id)
+                for binary_field in binary_fields.intersection(
+                                                    vals_by_id[record_id]):
+                    if doc.get(binary_field):
+                        old_oids.append(ObjectId(doc[binary_field]))
+
+        now = datetime.now()
+        requests = []
+        for record_id, vals in vals_by_id.iteritems():
+            vals = vals.copy()
+            #Pre process date and datetime fields
+            self.preformat_write_fields(vals)
+            if record_id in found:
+                self.write_binary_gridfs_fields(vals)
+            else:
+                for binary_field in binary_fields.intersection(vals):
+                    del vals[binary_field]
+            #Log access
+            vals.update({'write_uid': user,
+                         'write_date': now,
+                        })
+            requests.append(UpdateOne({'id': record_id}, {'$set': vals}))
+
+        batch_size = max(int(self._write_batch_size), 1)
+        try:
+            for start in xrange(0, len(requests), batch_size):
+                result = collection.bulk_write(
+                                requests[start:start + batch_size],
+                                ordered=False)
+                if not result.acknowledged:
+                    res = None
+                    continue
+                res['matched'] += result.matched_count
+                res['modified'] += result.modified_count
+        except OperationFailure, e:
+            raise except_orm('MongoDB update error', e)
+        finally:
+            self._invalidate_caches()
+        self.release_binary_gridfs_files(collection, old_oids)
+
+        return res
+
+    @instrumented('create')
     def create(self, cr, user, vals, context=None):
-        collection = mdbpool.get_collection(self._table)
+        collection = self.get_write_collection()
         vals = vals.copy()
 
         if not context:
@@ -365,15 +865,7 @@ class orm_mongodb(orm.orm_template):
                 vals.update(default_values)
 
         #Add incremental id to store vals
-        # Deprecated in pymongo 3.0.3
-        # counter = mdbpool.get_collection('counters').find_and_modify(
-        #             {'_id': self._table},
-        #             {'$inc': {'counter': 1}})
-        counter = mdbpool.get_collection('counters').find_one_and_update(
-                    {'_id': self._table},
-                    {'$inc': {'counter': 1}},
-                    upsert=True)
-        vals.update({'id': counter['counter']})
+        vals.update({'id': self._reserve_ids(1)[0]})
         #Pre proces date fields
         self.preformat_write_fields(vals)
         self.write_binary_gridfs_fields(vals)
@@ -383,63 +875,147 @@ class orm_mongodb(orm.orm_template):
                     })
 
         #Effectively create the record
-        collection.insert(vals)
+        try:
+            collection.insert_one(vals)
+        except OperationFailure, e:
+            raise except_orm('MongoDB create error', e)
+        finally:
+            self._invalidate_caches()
 
         return vals['id']
 
+    @instrumented('create_many')
+    def create_many(self, cr, user, vals_list, context=None):
+        """Create several records with a minimum of round trips.
+
+        All the ids are reserved with a single increment of the model
+        counter and the documents are written with unordered bulk
+        inserts of _insert_batch_size documents.
+        Returns the new ids in the same order as vals_list.
+        """
+        if not vals_list:
+            return []
+        collection = self.get_write_collection()
+        vals_list = [vals.copy() for vals in vals_list]
+
+        if not context:
+            context = {}
+        self.pool.get('ir.model.access').check(cr, user, self._name,
+                                               'create', context=context)
+
+        if self._defaults:
+            #Default values, computed once for the whole batch
+            missing = set()
+            for vals in vals_list:
+                missing.update(f for f in self._columns.keys()
+                                 if f not in vals)
+            if missing:
+                default_values = self.default_get(cr, user, list(missing),
+                                                  context)
+                for vals in vals_list:
+                    for key, value in default_values.iteritems():
+                        if key not in vals:
+                            vals[key] = value
+
+        ids = self._reserve_ids(len(vals_list))
+        now = datetime.now()
+        for vals, new_id in zip(vals_list, ids):
+            vals['id'] = new_id
+            #Pre proces date fields
+            self.preformat_write_fields(vals)
+            self.write_binary_gridfs_fields(vals)
+            #Log access
+            vals.update({'create_uid': user,
+                         'create_date': now,
+                        })
+
+        #Effectively create the records
+        batch_size = max(int(self._insert_batch_size), 1)
+        try:
+            for start in xrange(0, len(vals_list), batch_size):
+                collection.insert_many(vals_list[start:start + batch_size],
+                                       ordered=False)
+        except OperationFailure, e:
+            raise except_orm('MongoDB create error', e)
+        finally:
+            self._invalidate_caches()
+
+        return ids
+
+    def get_read_collection(self, context=None):
+        """Collection of the model for queries, routed with
+        context['read_preference'] or _read_preference and their
+        max staleness. Writes always use the primary."""
+        if not context:
+            context = {}
+        mode = context.get('read_preference', self._read_preference)
+        if not mode:
+            return mdbpool.get_collection(self._table)
+        max_staleness = context.get('max_staleness_seconds',
+                                    self._read_max_staleness)
+        return mdbpool.get_collection(self._table, read_preference=mode,
+                                      max_staleness=max_staleness)
+
+    def get_write_collection(self):
+        """Collection of the model for writes, with the _write_concern
+        of the model"""
+        return mdbpool.get_collection(self._table,
+                                      write_concern=self._write_concern)
+
+    def _reserve_ids(self, count):
+        """Reserve count new ids for the model. With _id_block_size
+        the ids come from the process local block allocator, otherwise
+        straight from the model counters document"""
+        get_counters = lambda: mdbpool.get_collection('counters')
+        if self._id_block_size:
+            allocator = id_allocator.get_allocator(get_counters, self._table,
+                                                   self._id_block_size)
+            return allocator.allocate(count)
+        return id_allocator.reserve_ids(get_counters(), self._table, count)
+
     def _compute_order(self, cr, user, order=None, context=None):
-        #Parse the order of the object to addapt it to MongoDB
+        """Parse an order like "a desc, b asc, id" into the MongoDB
+        sort [('a', -1), ('b', 1), ('id', 1)], keeping the keys in
+        order so compound indexes can serve it. The result is kept per
+        order string."""
 
         if not order:
             order = self._order
-
-        mongo_order = order.split(',')
-        #If we only have one order field
-        #it can contain asc or desc
-        #Otherwise is not allowed
-        if len(mongo_order) == 1:
-            reg_expr = '^(([a-z0-9_]+|"[a-z0-9_]+")( *desc)+( *, *|))+$'
-            order_desc = re.compile(reg_expr, re.I)
-            if order_desc.match(mongo_order[0].strip()):
-                return [(mongo_order[0].partition(' ')[0].strip(),
-                        pymongo.DESCENDING)]
-            else:
-                return [(mongo_order[0].partition(' ')[0].strip(),
-                        pymongo.ASCENDING)]
-        else:
+        res = self._orders.get(order)
+        if res is None:
             res = []
-            reg_expr = '^(([a-z0-9_]+|"[a-z0-9_]+")( *desc| *asc)+( *, *|))+$'
-            regex_order_mongo = re.compile(reg_expr, re.I)
-            for field in mongo_order:
-                if regex_order_mongo.match(field.strip()):
+            for term in order.split(','):
+                match = ORDER_TERM.match(term.strip())
+                if not match:
                     raise except_orm(_('Error'),
                         _('Bad order declaration for model %s') % (self._name))
+                field, direction = match.group(2), match.group(3)
+                if field in [key for key, value in res]:
+                    continue
+                if direction and direction.lower() == 'desc':
+                    res.append((field, pymongo.DESCENDING))
                 else:
-                    res.append((field.strip(), pymongo.ASCENDING))
-        return res
+                    res.append((field, pymongo.ASCENDING))
+            res = tuple(res)
+            self._orders.set(order, res)
+        return list(res)
 
+    @instrumented('search')
     def search(self, cr, user, args, offset=0, limit=0, order=None,
-            context=None, count=False):
-        #Make a copy of args for working
-        #Domain has to be list of lists
-        tmp_args = [isinstance(arg, tuple) and list(arg)
-                    or arg for arg in args]
-        collection = mdbpool.get_collection(self._table)
-        self.search_trans_fields(tmp_args)
-
-        new_args = mdbpool.translate_domain(tmp_args)
-        # Implement exact match for fields char which defaults to ilike
-        for k in new_args:
-            field = self._columns.get(k)
-            if not field:
-                pass
-            if getattr(field, 'exact_match', False):
-                if isinstance(new_args[k], re._pattern_type):
-                    new_args[k] = new_args[k].pattern.lstrip('.*').rstrip('.*')
+            context=None, count=False, after_id=None):
+        """Search the ids matching args.
+
+        Besides offset, results can be paginated by key (seek method)
+        with after_id, the last id of the previous page, or with a
+        context['search_after'] token holding the last id or a dict
+        with the values of the sort keys and id of the last record.
+        The offset is then ignored and deep pages cost the same as the
+        first one.
+        """
         if not context:
             context = {}
-        self.pool.get('ir.model.access').check(cr, user,
-                        self._name, 'read', context=context)
+        collection, tmp_args, new_args = self._search_domain(cr, user, args,
+                                                             context)
         #In very large collections when no args
         #orders all documents prior to return a result
         #so when no filters, order by id that is sure that
@@ -448,30 +1024,394 @@ class orm_mongodb(orm.orm_template):
             order = 'id'
 
         if count:
-            return collection.find(
+            return self._count(collection, tmp_args, new_args, context)
+
+        new_args, sort, offset = self._search_sort(cr, user, collection,
+                                                   new_args, offset, order,
+                                                   after_id, context)
+        cache, generation = self.get_query_cache()
+        if cache is not None:
+            query = BSON.encode({'filter': new_args, 'sort': sort})
+            key = ('search', query, int(offset), int(limit))
+            res = cache.get(key)
+            if res is not None:
+                return list(res)
+
+        mongo_cr = lambda: collection.find(
                     new_args,
                     {'id': 1},
+                    skip=int(offset),
+                    limit=int(limit),
                     no_cursor_timeout=True,
                     modifiers={"$snapshot": False},
-            ).count()
+                    sort=sort)
+
+        instrumentation.annotate(collection, new_args, sort)
+        start = time.time()
+        res = mdbpool.run(lambda: [x['id'] for x in mongo_cr()])
+        self._record_query(collection, new_args, sort, time.time() - start)
+
+        if cache is not None:
+            cache.set(key, tuple(res), len(query) + 8 * len(res), generation)
+        return res
 
-        mongo_cr = collection.find(
+    @instrumented('search_read')
+    def search_read(self, cr, user, domain=None, fields=None, offset=0,
+                    limit=0, order=None, context=None):
+        """search and read in one query: the matching documents are
+        fetched with the projection of fields, sorted and limited by
+        the server, and post processed like read does"""
+
+        if not context:
+            context = {}
+        if domain is None:
+            domain = []
+        if not fields:
+            fields = self._columns.keys()
+        collection, tmp_args, new_args = self._search_domain(cr, user,
+                                                             domain, context)
+        if not domain:
+            order = 'id'
+        new_args, sort, offset = self._search_sort(cr, user, collection,
+                                                   new_args, offset, order,
+                                                   None, context)
+        plan = self.get_read_plan(fields)
+        mongo_cr = lambda: collection.find(
                     new_args,
-                    {'id': 1},
+                    plan.fields_pre + ['id'],
                     skip=int(offset),
                     limit=int(limit),
-                    no_cursor_timeout=True,
-                    modifiers={"$snapshot": False},
-                    sort=self._compute_order(cr, user, order))
+                    sort=sort)
+        instrumentation.annotate(collection, new_args, sort)
+        start = time.time()
+        res = mdbpool.run(lambda: [x for x in mongo_cr()])
+        self._record_query(collection, new_args, sort, time.time() - start)
+        ids = [int(x['id']) for x in res]
+        self.apply_read_plan(cr, user, plan, ids, res, context)
+        return res
 
-        res = [x['id'] for x in mongo_cr]
+    @instrumented('read_group')
+    def read_group(self, cr, uid, domain, fields, groupby, offset=0,
+                   limit=None, context=None, orderby=False):
+        """Group the records matching domain by the first field of
+        groupby and aggregate the numeric fields with their
+        group_operator (sum by default), all done by a single
+        aggregation pipeline.
+
+        Date and datetime fields are grouped by 'field:day',
+        'field:month' or 'field:year', month when not given.
+        Returns the OpenERP read_group list of dicts with the group
+        value, <field>_count, the aggregates, __domain and __context.
+        """
+        if not context:
+            context = {}
+        if domain is None:
+            domain = []
+        if isinstance(groupby, basestring):
+            groupby = [groupby]
+        if not groupby:
+            raise except_orm('Invalid group_by', 'No field to group by')
+        field, interval = (groupby[0].split(':', 1) + [None])[:2]
+        column = self._columns.get(field)
+        if column is None:
+            raise except_orm('Invalid group_by',
+                             'Unknown field %s in group_by' % field)
+        is_date = field in self.get_date_fields()
+        if is_date:
+            interval = interval or 'month'
+            if interval not in GROUPBY_DATE_FORMATS:
+                raise except_orm('Invalid group_by',
+                                 'Unknown date interval %s' % interval)
+        elif interval:
+            raise except_orm('Invalid group_by',
+                             '%s is not a date field' % field)
+
+        #__domain of the groups, made of the untranslated domain
+        domain = [isinstance(arg, basestring) and arg or list(arg)
+                  for arg in domain]
+        collection, tmp_args, new_args = self._search_domain(cr, uid, domain,
+                                                             context)
+        is_bool = field in self.get_bool_fields()
+        #Group key, the date parts of the bucket for date fields
+        if is_date:
+            parts = GROUPBY_DATE_PARTS[:[x[0] for x in GROUPBY_DATE_PARTS]
+                                       .index(interval) + 1]
+            is_set = {'$eq': [{'$type': '$' + field}, 'date']}
+            key = SON((part, {'$cond': [is_set, {op: '$' + field}, None]})
+                      for part, op in parts)
+        elif is_bool:
+            #Null and missing values read as False, a single group
+            key = {'$ifNull': ['$' + field, False]}
+        else:
+            key = '$' + field
+        group = SON([('_id', key), ('__count', {'$sum': 1})])
+        aggregated = [f for f in fields or []
+                      if f != field and f in self._columns
+                      and self._columns[f]._type in NUMERIC_TYPES]
+        for f in aggregated:
+            operator = getattr(self._columns[f], 'group_operator',
+                               None) or 'sum'
+            if operator == 'count':
+                group[f] = {'$sum': {'$cond': [{'$gt': ['$' + f, None]},
+                                               1, 0]}}
+            elif operator in GROUP_OPERATORS:
+                group[f] = {GROUP_OPERATORS[operator]: '$' + f}
+            else:
+                raise except_orm('Invalid group_by',
+                                 'Unsupported group operator %s of %s'
+                                 % (operator, f))
+
+        sort = SON()
+        for part in (orderby or '').split(','):
+            part = part.split()
+            if not part:
+                continue
+            name = part[0]
+            if name in (field, groupby[0]):
+                sort_key = '_id'
+            elif name == field + '_count':
+                sort_key = '__count'
+            elif name in aggregated:
+                sort_key = name
+            else:
+                raise except_orm('Invalid group_by',
+                                 'Cannot order groups by %s' % name)
+            desc = len(part) > 1 and part[1].lower() == 'desc'
+            sort[sort_key] = desc and pymongo.DESCENDING or pymongo.ASCENDING
+        if '_id' not in sort:
+            sort['_id'] = pymongo.ASCENDING
+
+        pipeline = []
+        if new_args:
+            pipeline.append({'$match': new_args})
+        pipeline.extend([{'$group': group}, {'$sort': sort}])
+        if offset:
+            pipeline.append({'$skip': int(offset)})
+        if limit:
+            pipeline.append({'$limit': int(limit)})
+        instrumentation.annotate(collection, new_args)
+        groups = mdbpool.run(lambda: list(collection.aggregate(
+                                                pipeline, allowDiskUse=True)))
+
+        names = {}
+        if column._type == 'many2one':
+            values = [doc['_id'] for doc in groups if doc['_id']]
+            if values:
+                names = dict(self.pool.get(column._obj).name_get(
+                                    cr, uid, values, context=context))
+        res = []
+        for doc in groups:
+            value = doc['_id']
+            group_res = {field + '_count': doc['__count'],
+                         '__context': {'group_by': groupby[1:]}}
+            if is_date:
+                if value is None or value.get('year') is None:
+                    group_res[field] = False
+                    group_res['__domain'] = domain + [[field, '=', None]]
+                else:
+                    start = datetime(value['year'], value.get('month', 1),
+                                     value.get('day', 1))
+                    if interval == 'day':
+                        end = start + timedelta(days=1)
+                    elif interval == 'month':
+                        end = datetime(start.year + start.month / 12,
+                                       start.month % 12 + 1, 1)
+                    else:
+                        end = datetime(start.year + 1, 1, 1)
+                    group_res[field] = start.strftime(
+                                            GROUPBY_DATE_FORMATS[interval])
+                    group_res['__domain'] = domain + [
+                                    [field, '>=', start.strftime('%Y-%m-%d')],
+                                    [field, '<', end.strftime('%Y-%m-%d')]]
+            elif is_bool and not value:
+                group_res['__domain'] = domain + ['|', [field, '=', False],
+                                                  [field, '=', None]]
+                group_res[field] = False
+            else:
+                group_res['__domain'] = domain + [[field, '=', value]]
+                value = False if value is None else value
+                if value and column._type == 'many2one':
+                    value = (value, names.get(value, False))
+                group_res[field] = value
+            for f in aggregated:
+                value = doc.get(f)
+                group_res[f] = False if value is None else value
+            res.append(group_res)
+        return res
+
+    def _search_domain(self, cr, user, args, context):
+        """Check read access and translate the domain args.
+        Returns the read collection, the domain as a list of lists and
+        the MongoDB filter"""
+
+        #Make a copy of args for working, search_trans_fields changes
+        #the leaves in place. Domain has to be list of lists
+        tmp_args = [isinstance(arg, basestring) and arg or list(arg)
+                    for arg in args]
+        self.search_trans_fields(tmp_args)
+
+        with instrumentation.operation(self._name, 'translate_domain'):
+            new_args = mdbpool.translate_domain(tmp_args)
+        collection = self.get_read_collection(context)
+        self.pool.get('ir.model.access').check(cr, user,
+                        self._name, 'read', context=context)
+        return collection, tmp_args, new_args
+
+    def _search_sort(self, cr, user, collection, new_args, offset, order,
+                     after_id, context):
+        """Returns the filter, sort and offset of a search, with the
+        keyset condition of after_id or context['search_after']"""
+
+        sort = self._compute_order(cr, user, order)
+        after = after_id or context.get('search_after')
+        if after:
+            #Keyset pagination, id is the tie breaker of the sort keys
+            if 'id' not in [key for key, direction in sort]:
+                sort = sort + [('id', pymongo.ASCENDING)]
+            keyset = self._keyset_filter(collection, sort, after)
+            new_args = new_args and {'$and': [new_args, keyset]} or keyset
+            offset = 0
+        return new_args, sort, offset
+
+    def _count(self, collection, args, new_args, context):
+        """Count the documents matching new_args.
+
+        Without filters the count comes from the collection metadata.
+        Filtered counts stop at context['count_limit'] or _count_limit
+        when set, so a caller can show "10000+". With _count_cache_ttl
+        results are kept for that many seconds or until the next write.
+        """
+        limit = int(context.get('count_limit', self._count_limit) or 0)
+        if self._count_cache_ttl:
+            key = repr((args, limit))
+            cached = self._count_cache.get(key)
+            if cached and cached[0] > time.time():
+                return cached[1]
+        if not new_args:
+            res = mdbpool.run(collection.estimated_document_count)
+            if limit:
+                res = min(res, limit)
+        elif limit:
+            res = mdbpool.run(collection.count_documents, new_args,
+                              limit=limit)
+        else:
+            res = mdbpool.run(collection.count_documents, new_args)
+        if self._count_cache_ttl:
+            if len(self._count_cache) >= 1000:
+                self._count_cache.clear()
+            self._count_cache[key] = (time.time() + self._count_cache_ttl,
+                                      res)
+        return res
 
+    def _invalidate_caches(self):
+        """Drop the cached results of the model after a change"""
+        self._count_cache.clear()
+        if self._query_cache:
+            generations = mdbpool.get_collection(query_cache.GENERATIONS)
+            self._result_cache.sync(query_cache.bump_generation(
+                                        generations, self._table))
+
+    def get_query_cache(self):
+        """Return the query cache of the model and its generation,
+        checked against the generations collection, or (None, None)
+        when the model does not use it"""
+        if not self._query_cache:
+            return None, None
+        generations = mdbpool.get_collection(query_cache.GENERATIONS)
+        generation = mdbpool.run(query_cache.get_generation, generations,
+                                 self._table)
+        return self._result_cache, self._result_cache.sync(generation)
+
+    def get_query_cache_stats(self):
+        """Hit/miss statistics of the query cache of the model"""
+        return self._result_cache.stats()
+
+    def _record_query(self, collection, spec, sort, elapsed):
+        """Account a search in the index advisor and, with
+        _auto_indexes, create the index its shape lacks"""
+        if not (index_advisor.recording or self._auto_indexes):
+            return
+        stats = index_advisor.advisor.record(collection, spec, sort, elapsed)
+        if not (self._auto_indexes and stats
+                and stats['count'] >= index_advisor.min_count
+                and stats.get('checked') != stats['explained']):
+            return
+        stats['checked'] = stats['explained']
+        if index_advisor.needs_index(stats, collection.index_information()):
+            netsvc.Logger().notifyChannel('MongoDB', netsvc.LOG_INFO,
+                'creating index %s on %s' % (stats['index'], self._table))
+            try:
+                collection.create_index(stats['index'], background=True)
+            except OperationFailure, e:
+                netsvc.Logger().notifyChannel('MongoDB', netsvc.LOG_WARNING,
+                    'index %s on %s not created: %s' % (stats['index'],
+                                                        self._table, e))
+
+    def get_index_report(self):
+        """Recorded search shapes of the model, the slowest first, with
+        the index recommended for each and whether it exists"""
+        collection = mdbpool.get_collection(self._table)
+        indexes = mdbpool.run(collection.index_information)
+        res = index_advisor.advisor.report(self._table)
+        for stats in res:
+            stats['covered'] = index_advisor.is_covered(stats['index'],
+                                                        indexes)
         return res
 
+    def _keyset_filter(self, collection, sort, after):
+        """Build the filter selecting the documents placed after the
+        last record of the previous page for the sort keys sort.
+
+        after is the id of the last record or a dict with the values
+        of the sort keys of that record.
+        """
+        keys = [key for key, direction in sort]
+        if isinstance(after, dict):
+            missing = [key for key in keys if key not in after]
+            if missing:
+                raise except_orm('MongoDB search error',
+                                 'search_after of %s lacks the sort keys %s'
+                                 % (self._name, ', '.join(missing)))
+            last = after.copy()
+            date_fields = self.get_date_fields()
+            for key in keys:
+                if key in date_fields and isinstance(last.get(key),
+                                                     basestring):
+                    last[key] = self.transform_date_field(key, last[key],
+                                                          'write')
+        else:
+            last = mdbpool.run(collection.find_one, {'id': int(after)}, keys)
+            if not last:
+                raise except_orm('MongoDB search error',
+                                 'Record %s of the previous page of %s '
+                                 'does not exist' % (after, self._name))
+        #(k1 > v1) or (k1 = v1 and k2 > v2) or ...
+        #Null and missing values sort before any other value, {k: None}
+        #matches both
+        clauses = []
+        for pos, (key, direction) in enumerate(sort):
+            clause = dict((k, last.get(k)) for k in keys[:pos])
+            value = last.get(key)
+            if direction == pymongo.ASCENDING:
+                if value is None:
+                    clause[key] = {'$ne': None}
+                else:
+                    clause[key] = {'$gt': value}
+            else:
+                if value is None:
+                    #Nothing sorts after null in descending order
+                    continue
+                clause['$or'] = [{key: {'$lt': value}}, {key: None}]
+            clauses.append(clause)
+        if not clauses:
+            #Nothing after the last record
+            return {'id': {'$in': []}}
+        return {'$or': clauses}
+
+    @instrumented('unlink')
     def unlink(self, cr, uid, ids, context=None):
 
-        db = mdbpool.get_db()
-        collection = mdbpool.get_collection(self._table)
+        collection = self.get_write_collection()
 
         if not ids:
             return True
@@ -481,13 +1421,17 @@ class orm_mongodb(orm.orm_template):
         self.pool.get('ir.model.access').check(cr, uid, self._name,
                                                'unlink', context=context)
 
-        # Remove binary fields (files in gridfs)
-        self.unlink_binary_gridfs_fields(collection, ids)
-        #Remove with safe mode
-        collection.remove({'id': {'$in': ids}}, True)
-
-        if db.error():
-            raise except_orm('MongoDB unlink error', db.error())
+        oids = self.get_binary_gridfs_oids(collection, ids)
+        #Remove, acknowledged as set by _write_concern
+        try:
+            collection.delete_many({'id': {'$in': ids}})
+        except OperationFailure, e:
+            raise except_orm('MongoDB unlink error', e)
+        finally:
+            self._invalidate_caches()
+        # Remove binary fields (files in gridfs) once nothing
+        # references them
+        self.release_binary_gridfs_files(collection, oids)
 
         return True
 
@@ -495,6 +1439,7 @@ class orm_mongodb(orm.orm_template):
         # nothing to check in schema free...
         pass
 
+    @instrumented('perm_read')
     def perm_read(self, cr, user, ids, context=None, details=True):
 
         if not ids:
@@ -503,14 +1448,14 @@ class orm_mongodb(orm.orm_template):
         if isinstance(ids, (int, long)):
             ids = [ids]
 
-        collection = mdbpool.get_collection(self._table)
+        collection = self.get_read_collection(context)
 
         fields = ['id', 'create_uid', 'create_date',
                   'write_uid', 'write_date']
 
         res = []
-        mongo_cr = collection.find({'id': {'$in': ids}}, fields)
-        res = [x for x in mongo_cr]
+        mongo_cr = lambda: collection.find({'id': {'$in': ids}}, fields)
+        res = mdbpool.run(lambda: [x for x in mongo_cr()])
         for doc in res:
             docfields = doc.keys()
             for field in fields:
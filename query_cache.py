@@ -0,0 +1,133 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP - MongoDB backend
+#    Copyright (C) 2011 Joan M. Grande
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""In process cache of query results invalidated by generation.
+
+Every model using the cache has a document in the generations
+collection whose counter is increased on each change. Processes compare
+it with the generation of their cached entries before using them, so
+changes made by any process are seen on the next access.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from pymongo import ReturnDocument
+
+GENERATIONS = 'query_cache_generations'
+
+
+def get_generation(generations, name):
+    """Current generation of the model name"""
+    doc = generations.find_one({'_id': name})
+    return doc and doc['generation'] or 0
+
+
+def bump_generation(generations, name):
+    """Start a new generation of the model name and return it"""
+    doc = generations.find_one_and_update(
+                {'_id': name},
+                {'$inc': {'generation': 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER)
+    return doc['generation']
+
+
+class QueryCache(object):
+    """Thread safe LRU mapping bounded to max_entries entries and
+    max_bytes of estimated size, holding the entries of a single
+    generation"""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+    def sync(self, generation):
+        """Drop the entries when generation is not theirs.
+        Returns generation"""
+        with self._lock:
+            if generation != self.generation:
+                if self._data:
+                    self.invalidations += 1
+                self._data.clear()
+                self._bytes = 0
+                self.generation = generation
+        return generation
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size, generation):
+        """Store value unless the cache moved to another generation
+        since generation was read"""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            while (len(self._data) > self.max_entries
+                   or self._bytes > self.max_bytes):
+                old_key, old = self._data.popitem(last=False)
+                self._bytes -= old[1]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Hit/miss statistics and usage of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': lookups and float(self.hits) / lookups or 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'generation': self.generation,
+            }
+
+    def __len__(self):
+        return len(self._data)
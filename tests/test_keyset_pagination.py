@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Keyset pagination of search with null sort keys, against mongomock
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'benchmarks'))
+import stubs
+stubs.install({'mongodb_name': 'test_mongodb_backend'})
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+class KeysetPaginationTest(unittest.TestCase):
+
+    def setUp(self):
+        if mongomock is None:
+            self.skipTest('mongomock is not installed')
+        import mongodb2
+        from osv import fields
+        import orm_mongodb
+
+        client = mongomock.MongoClient()
+        mongodb2.mdbpool.mongo_connect = lambda: client
+        mongodb2.mdbpool._connection = None
+
+        class keyset_record(orm_mongodb.orm_mongodb):
+            _name = 'keyset.record'
+            _table = 'keyset_record'
+            _columns = {'name': fields.char('Name', size=64)}
+
+        self.model = stubs.make_model(keyset_record)
+        self.model._auto_init(stubs.Cursor())
+        self.ids = [self.model.create(None, 1, vals) for vals in
+                    ({}, {'name': 'a'}, {'name': 'b'}, {'name': 'c'})]
+
+    def search(self, order, after_id):
+        return self.model.search(None, 1, [('id', '>', 0)], 0, 0, order,
+                                 after_id=after_id)
+
+    def search_token(self, order, token):
+        return self.model.search(None, 1, [('id', '>', 0)], 0, 0, order,
+                                 context={'search_after': token})
+
+    def test_ascending_after_null(self):
+        self.assertEqual(self.search('name', self.ids[0]), self.ids[1:])
+
+    def test_ascending_after_value(self):
+        self.assertEqual(self.search('name', self.ids[1]), self.ids[2:])
+
+    def test_descending_reaches_null(self):
+        self.assertEqual(self.search('name desc', self.ids[2]),
+                         [self.ids[1], self.ids[0]])
+
+    def test_descending_after_null(self):
+        self.assertEqual(self.search('name desc', self.ids[0]), [])
+
+    def test_token_after_value(self):
+        token = {'name': 'b', 'id': self.ids[2]}
+        self.assertEqual(self.search_token('name', token), self.ids[3:])
+
+    def test_token_after_null(self):
+        token = {'name': None, 'id': self.ids[0]}
+        self.assertEqual(self.search_token('name', token), self.ids[1:])
+
+    def test_token_without_id(self):
+        from osv.orm import except_orm
+        self.assertRaises(except_orm, self.search_token, 'name',
+                          {'name': 'b'})
+
+    def test_token_without_sort_key(self):
+        from osv.orm import except_orm
+        self.assertRaises(except_orm, self.search_token, 'name',
+                          {'id': self.ids[2]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Translation of OpenERP domains to MongoDB filters by shape
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'benchmarks'))
+import stubs
+stubs.install({'mongodb_name': 'test_mongodb_backend'})
+
+import mongodb2
+from osv.orm import except_orm
+
+
+class TranslateDomainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = mongodb2.MDBConn()
+
+    def translate(self, domain):
+        return self.pool.translate_domain(domain)
+
+    def test_empty(self):
+        self.assertEqual(self.translate([]), {})
+
+    def test_leaf(self):
+        self.assertEqual(self.translate([('name', '=', 'ol')]),
+                         {'name': 'ol'})
+        self.assertEqual(self.translate([('id', 'not in', [1, 2])]),
+                         {'id': {'$nin': [1, 2]}})
+
+    def test_implicit_and(self):
+        self.assertEqual(self.translate([('name', '=', 'ol'),
+                                         ('id', '>', 10)]),
+                         {'name': 'ol', 'id': {'$gt': 10}})
+
+    def test_or(self):
+        self.assertEqual(self.translate(['|', ('name', '=', 'ol'),
+                                         ('id', '>', 10)]),
+                         {'$or': [{'name': 'ol'}, {'id': {'$gt': 10}}]})
+
+    def test_not(self):
+        self.assertEqual(self.translate(['!', ('name', '=', 'ol')]),
+                         {'$nor': [{'name': 'ol'}]})
+
+    def test_nested(self):
+        domain = ['|', '&', ('a', '=', 1), ('b', '=', 2),
+                  '!', '|', ('c', '=', 3), ('d', '=', 4)]
+        self.assertEqual(self.translate(domain),
+                         {'$or': [{'a': 1, 'b': 2},
+                                  {'$nor': [{'$or': [{'c': 3},
+                                                     {'d': 4}]}]}]})
+
+    def test_nested_or_is_flattened(self):
+        domain = ['|', ('a', '=', 1), '|', ('b', '=', 2), ('c', '=', 3)]
+        self.assertEqual(self.translate(domain),
+                         {'$or': [{'a': 1}, {'b': 2}, {'c': 3}]})
+
+    def test_or_joined_with_implicit_and(self):
+        domain = [('a', '=', 1), '|', ('b', '=', 2), ('c', '=', 3)]
+        self.assertEqual(self.translate(domain),
+                         {'a': 1, '$or': [{'b': 2}, {'c': 3}]})
+
+    def test_same_field_merged(self):
+        self.assertEqual(self.translate([('id', '>', 10), ('id', '<', 15)]),
+                         {'id': {'$gt': 10, '$lt': 15}})
+
+    def test_same_field_clash_uses_and(self):
+        self.assertEqual(self.translate([('id', '>', 10), ('id', '>', 15)]),
+                         {'$and': [{'id': {'$gt': 10}},
+                                   {'id': {'$gt': 15}}]})
+        self.assertEqual(self.translate([('a', '=', 1), ('a', '=', 2)]),
+                         {'$and': [{'a': 1}, {'a': 2}]})
+
+    def test_missing_operand(self):
+        self.assertRaises(except_orm, self.translate,
+                          ['|', ('a', '=', 1)])
+        self.assertRaises(except_orm, self.translate, ['!'])
+
+    def test_unknown_domain_operator(self):
+        self.assertRaises(except_orm, self.translate,
+                          ['^', ('a', '=', 1), ('b', '=', 2)])
+
+    def test_unsupported_operator(self):
+        self.assertRaises(except_orm, self.translate,
+                          [('a', 'child_of', 1)])
+
+    def test_shape_cache_reuse(self):
+        shape, values = self.pool.domain_shape([('a', '=', 1),
+                                                ('b', '>', 2)])
+        self.assertEqual(shape, (('a', '='), ('b', '>')))
+        self.assertEqual(values, [1, 2])
+        builder = self.pool.compile_domain(shape)
+        self.assertTrue(self.pool.compile_domain(shape) is builder)
+        self.assertEqual(len(self.pool._domain_cache), 1)
+        self.assertEqual(self.translate([('a', '=', 5), ('b', '>', 6)]),
+                         {'a': 5, 'b': {'$gt': 6}})
+        self.assertEqual(self.translate([('a', '=', 1), ('b', '>', 2)]),
+                         {'a': 1, 'b': {'$gt': 2}})
+        self.assertEqual(len(self.pool._domain_cache), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Translation of LIKE patterns to regular expressions and prefix
+ranges
+
+    python -m unittest discover tests
+"""
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'benchmarks'))
+import stubs
+stubs.install({'mongodb_name': 'test_mongodb_backend'})
+
+from mongodb2 import translate_like, _like
+
+
+class TranslateLikeTest(unittest.TestCase):
+
+    def pattern(self, value, ignore_case=False):
+        return translate_like(value, ignore_case)[0].pattern
+
+    def bounds(self, value, ignore_case=False):
+        return translate_like(value, ignore_case)[1]
+
+    def test_without_wildcard_matches_anywhere(self):
+        self.assertEqual(self.pattern('abc'), 'abc')
+        self.assertEqual(self.bounds('abc'), None)
+
+    def test_escaping(self):
+        regex = translate_like('a.b*(c)')[0]
+        self.assertTrue(regex.search('xa.b*(c)y'))
+        self.assertFalse(regex.search('axb*(c)'))
+        self.assertFalse(regex.search('a.bbb(c)'))
+
+    def test_anchoring(self):
+        self.assertEqual(self.pattern('abc%'), '^abc')
+        self.assertEqual(self.pattern('%abc'), 'abc$')
+        self.assertEqual(self.pattern('a%c'), '^a.*c$')
+
+    def test_leading_and_trailing_wildcards_trimmed(self):
+        self.assertEqual(self.pattern('%abc%'), 'abc')
+        self.assertEqual(self.pattern('%a%c%'), 'a.*c')
+        self.assertEqual(self.pattern('%'), '')
+
+    def test_ignore_case(self):
+        regex = translate_like('%abc%', True)[0]
+        self.assertEqual(regex.flags & re.I, re.I)
+        self.assertTrue(regex.search('xABCy'))
+        self.assertFalse(translate_like('%abc%')[0].flags & re.I)
+
+    def test_prefix_bounds(self):
+        self.assertEqual(self.bounds('abc%'), ('abc', 'abd'))
+        self.assertEqual(self.bounds(u'ab\xe9%'), (u'ab\xe9', u'ab\xea'))
+        self.assertTrue(isinstance(self.bounds(u'xyz%')[1], unicode))
+
+    def test_no_bounds_past_last_character(self):
+        self.assertEqual(self.bounds('ab\x7f%'), None)
+        self.assertEqual(self.bounds('ab\xc3%'), None)
+        self.assertEqual(self.bounds(u'ab\ud7ff%'), None)
+
+    def test_no_bounds_unless_pure_prefix(self):
+        self.assertEqual(self.bounds('%'), None)
+        self.assertEqual(self.bounds('%abc'), None)
+        self.assertEqual(self.bounds('a%c%'), None)
+        self.assertEqual(self.bounds('a%c'), None)
+
+    def test_ilike_never_bounded(self):
+        self.assertEqual(self.bounds('abc%', True), None)
+        self.assertEqual(self.pattern('abc%', True), '^abc')
+
+    def test_cached(self):
+        self.assertTrue(translate_like('cached%') is
+                        translate_like('cached%'))
+        self.assertFalse(translate_like('cached%') is
+                         translate_like('cached%', True))
+
+    def test_like_filter(self):
+        self.assertEqual(_like('name', 'abc%'),
+                         {'name': {'$gte': 'abc', '$lt': 'abd'}})
+        res = _like('name', '%abc%')
+        self.assertEqual(res['name']['$regex'].pattern, 'abc')
+
+
+if __name__ == '__main__':
+    unittest.main()